@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+PyHub Chatbot Benchmark
+Drives the chatbot backend with realistic mixed workloads and reports
+throughput, p50/p95/p99 latency and peak RSS as machine-readable JSON.
+
+Usage:
+    python benchmark_chatbot.py                      # default sizes
+    python benchmark_chatbot.py --sizes 100 100000   # pattern table sizes
+    python benchmark_chatbot.py --output run.json    # save results for diffing
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TOPIC_TEMPLATES = [
+    "{}",
+    "what is {}",
+    "how do i use {} in python",
+    "can you explain {}",
+    "please explain simply: {}",
+    "please provide a brief, concise answer: {}",
+]
+
+CODE_SNIPPETS = [
+    "x = 5\nprint(x * 2)",
+    "```python\nfor i in range(10):\n    print(i)\n```",
+    "def greet(name):\n    return f'Hello {name}'\nprint(greet('PyHub'))",
+    "my_list = [1, 2, 3]\nprint(my_list[5])",
+    "```python\ndef broken(:\n    pass\n```",
+    "total = sum([n * n for n in range(100)])\nprint(total)",
+    "data = {'a': 1}\nprint(data['b'])",
+    "if x = 5:\n    print('five')",
+]
+
+FILLER_WORDS = [
+    "python", "list", "loop", "function", "class", "string", "dict", "file", "error",
+    "module", "web", "data", "test", "async", "thread", "parse", "format", "sort",
+    "search", "number", "convert", "read", "write", "json", "api", "server", "object",
+]
+
+STYLES = ['balanced', 'detailed', 'concise', 'beginner']
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KB, or None if unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def misspell(text, rng):
+    """Introduce one random typo: drop, swap or duplicate a character"""
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    kind = rng.choice(('drop', 'swap', 'double'))
+    if kind == 'drop':
+        return text[:i] + text[i + 1:]
+    if kind == 'swap':
+        return text[:i - 1] + text[i] + text[i - 1] + text[i + 1:]
+    return text[:i] + text[i] + text[i:]
+
+
+def pasted_message(patterns, rng):
+    """A long pasted message: paragraphs of prose or a big code listing, 2-16 KB"""
+    size = rng.randint(2048, 16384)
+    parts = []
+    if rng.random() < 0.5:
+        while sum(map(len, parts)) < size:
+            words = rng.choices(FILLER_WORDS, k=rng.randint(8, 20))
+            parts.append(' '.join(words).capitalize() + '.' + rng.choice((' ', ' ', '\n\n')))
+        parts.append(f"So how do i use {rng.choice(patterns)}?")
+        return ''.join(parts)
+    while sum(map(len, parts)) < size:
+        parts.append(rng.choice(CODE_SNIPPETS).replace('```python\n', '').replace('\n```', ''))
+    code = '\n'.join(parts)
+    return f"```python\n{code}\n```" if rng.random() < 0.5 else code
+
+
+def build_workloads(patterns, count, rng):
+    """Request mixes keyed by workload name; each item is (message, style)"""
+    topics = [rng.choice(TOPIC_TEMPLATES).format(rng.choice(patterns)) for _ in range(count)]
+    fuzzy = [misspell(rng.choice(patterns), rng) for _ in range(count)]
+    code = [rng.choice(CODE_SNIPPETS) for _ in range(count)]
+    mixed = [rng.choice((topics, topics, fuzzy, code))[i] for i in range(count)]
+    # Distinct long messages are few and slow to score, so reuse a small set
+    pastes = [pasted_message(patterns, rng) for _ in range(min(count, 20))]
+    pasted = [rng.choice(pastes) for _ in range(count)]
+
+    def styled(messages):
+        return [(message, rng.choice(STYLES)) for message in messages]
+
+    return {
+        'topics': styled(topics),
+        'fuzzy': styled(fuzzy),
+        'code': styled(code),
+        'mixed': styled(mixed),
+        'pasted': styled(pasted),
+    }
+
+
+def grow_patterns(bot, target, rng):
+    """Pad the patterns table with synthetic custom rows up to target rows"""
+    with bot.db.connection() as conn:
+        current = conn.execute("SELECT COUNT(*) FROM patterns").fetchone()[0]
+
+    # (pattern, category) is unique, so keep drawing until enough new rows stuck
+    while current < target:
+        rows = []
+        for i in range(target - current):
+            words = rng.sample(FILLER_WORDS, rng.randint(2, 4))
+            pattern = ' '.join(words)
+            rows.append((pattern, f"Synthetic answer #{current + i} about {pattern}.", 'benchmark'))
+        with bot.db.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO patterns (pattern, response, category) VALUES (?, ?, ?)", rows)
+            current = conn.execute("SELECT COUNT(*) FROM patterns").fetchone()[0]
+
+    bot.rebuild_index()
+    bot.response_cache.clear()
+    return current
+
+
+def measure(name, calls, operation):
+    """Run operation over calls, returning a result row with latency stats"""
+    latencies = []
+    started = time.perf_counter()
+    for call in calls:
+        t0 = time.perf_counter()
+        operation(call)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'target': name,
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_size(backend, size, requests, rng, use_cache):
+    """Benchmark every target at one pattern table size"""
+    bot = backend.get_chatbot()
+    client = backend.app.test_client()
+    actual = grow_patterns(bot, size, rng)
+    if not use_cache:
+        bot.response_cache.max_entries = 0
+        bot.code_cache.max_entries = 0
+
+    patterns = list(bot.pattern_index.patterns)
+    workloads = build_workloads(patterns, requests, rng)
+    rows = []
+
+    def record(row, workload):
+        row.update({'pattern_rows': actual, 'workload': workload})
+        rows.append(row)
+        print(f"  {row['target']:<24} {workload:<7} {row['throughput_rps']:>9} req/s  "
+              f"p50 {row['p50_ms']:>8.2f} ms  p95 {row['p95_ms']:>8.2f} ms  p99 {row['p99_ms']:>8.2f} ms")
+
+    store = bot.pattern_index.memory_usage()
+    rows.append({'target': 'pattern_store', 'pattern_rows': actual, 'workload': 'memory',
+                 'index_bytes': store['total'], 'bytes_per_pattern': store['per_pattern'],
+                 'peak_rss_kb': peak_rss_kb()})
+    print(f"  {'pattern_store':<24} {'memory':<7} {store['total'] / 1048576:>9.1f} MB      "
+          f"{store['per_pattern']} bytes/pattern")
+
+    for workload, calls in workloads.items():
+        record(measure('get_response', calls, lambda c: bot.get_response(c[0], style=c[1])), workload)
+
+    for workload in ('mixed', 'pasted'):
+        record(measure('extract_code', workloads[workload],
+                       lambda c: bot.extract_code_from_message(c[0])), workload)
+
+    code_calls = workloads['code']
+    record(measure('check_code_and_respond', code_calls,
+                   lambda c: bot.check_code_and_respond(c[0], c[1])), 'code')
+
+    for workload in ('mixed', 'fuzzy'):
+        record(measure('/api/chat', workloads[workload],
+                       lambda c: client.post('/api/chat', json={'message': c[0], 'style': c[1]})), workload)
+
+    record(measure('/api/stats', range(requests), lambda _: client.get('/api/stats')), 'poll')
+
+    train_calls = [(f"benchmark training pattern {size}-{i}", f"Benchmark answer {i}") for i in range(max(1, requests // 10))]
+    record(measure('/api/train', train_calls,
+                   lambda c: client.post('/api/train', json={'pattern': c[0], 'response': c[1], 'category': 'benchmark'})),
+           'train')
+
+    bot.conversation_log.flush()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PyHub chatbot backend')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='pattern table sizes to benchmark (default: 100 1000 10000 100000)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per workload (default: 200)')
+    parser.add_argument('--seed', type=int, default=1234, help='random seed for reproducible workloads')
+    parser.add_argument('--matcher', choices=['index', 'tfidf'], help='matcher backend (default: PYBOT_MATCHER)')
+    parser.add_argument('--cache', action='store_true', help='keep the reply and code-check caches enabled')
+    parser.add_argument('--output', help='write JSON results to this file (default: stdout)')
+    args = parser.parse_args()
+
+    # Progress and backend log lines go to stderr so stdout stays valid JSON
+    json_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    workdir = tempfile.mkdtemp(prefix='pybot-bench-')
+    os.environ['PYBOT_DB_PATH'] = os.path.join(workdir, 'benchmark.db')
+    if args.matcher:
+        os.environ['PYBOT_MATCHER'] = args.matcher
+
+    # Import after configuring so the module-level chatbot uses the scratch database
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import chatbot_backend as backend
+
+    rng = random.Random(args.seed)
+    results = []
+    for size in sorted(args.sizes):
+        print(f"📊 Pattern table: {size} rows")
+        results.extend(run_size(backend, size, args.requests, rng, args.cache))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'matcher': backend.get_chatbot().matcher_name,
+            'cache': args.cache,
+            'seed': args.seed,
+            'requests_per_workload': args.requests,
+        },
+        'peak_rss_kb': peak_rss_kb(),
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f"✅ Results written to {args.output}")
+    else:
+        print(output, file=json_out)
+
+
+if __name__ == '__main__':
+    main()
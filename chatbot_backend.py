@@ -5,27 +5,655 @@ A local AI chatbot using pattern matching and machine learning - no external API
 Compatible with Python 3.13+
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
 import json
+import csv
+import io
 import re
 import random
 import sqlite3
 import os
 import ast
 import sys
+import hashlib
+import mmap
+import struct
+import subprocess
 import traceback
-import re
-from datetime import datetime
+import threading
+import queue
+import heapq
+import bisect
+import atexit
+import time
+import signal
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from datetime import datetime, timedelta, timezone
 from difflib import SequenceMatcher
-from io import StringIO
+
+try:
+    import numpy as np
+except ImportError:  # optional - only needed for the tfidf matcher
+    np = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Runtime configuration - override with environment variables
+DB_PATH = os.environ.get('PYBOT_DB_PATH', 'pybot_conversations.db')
+DB_POOL_SIZE = int(os.environ.get('PYBOT_DB_POOL_SIZE', '8'))
+DB_CACHE_SIZE_KB = int(os.environ.get('PYBOT_DB_CACHE_SIZE_KB', '16384'))
+DB_MMAP_SIZE = int(os.environ.get('PYBOT_DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+LOG_QUEUE_SIZE = int(os.environ.get('PYBOT_LOG_QUEUE_SIZE', '10000'))
+LOG_BATCH_SIZE = int(os.environ.get('PYBOT_LOG_BATCH_SIZE', '500'))
+LOG_FLUSH_INTERVAL = float(os.environ.get('PYBOT_LOG_FLUSH_INTERVAL', '1.0'))
+LOG_BLOCK_TIMEOUT = float(os.environ.get('PYBOT_LOG_BLOCK_TIMEOUT', '0'))
+CACHE_SIZE = int(os.environ.get('PYBOT_CACHE_SIZE', '2048'))
+CACHE_TTL = float(os.environ.get('PYBOT_CACHE_TTL', '600'))
+CODE_CACHE_SIZE = int(os.environ.get('PYBOT_CODE_CACHE_SIZE', '1024'))
+CODE_CACHE_MAX_BYTES = int(os.environ.get('PYBOT_CODE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+CODE_CACHE_PERSIST = os.environ.get('PYBOT_CODE_CACHE_PERSIST', '0') == '1'
+BATCH_MAX_MESSAGES = int(os.environ.get('PYBOT_BATCH_MAX_MESSAGES', '5000'))
+IMPORT_BATCH_SIZE = int(os.environ.get('PYBOT_IMPORT_BATCH_SIZE', '5000'))
+RETENTION_DAYS = float(os.environ.get('PYBOT_RETENTION_DAYS', '0'))  # 0 keeps conversations forever
+RETENTION_MODE = os.environ.get('PYBOT_RETENTION_MODE', 'archive')  # 'archive' or 'delete'
+RETENTION_CHUNK = int(os.environ.get('PYBOT_RETENTION_CHUNK', '5000'))
+RETENTION_INTERVAL = float(os.environ.get('PYBOT_RETENTION_INTERVAL', '3600'))
+STATS_RECONCILE_INTERVAL = float(os.environ.get('PYBOT_STATS_RECONCILE_INTERVAL', '30'))
+PATTERN_REFRESH_INTERVAL = float(os.environ.get('PYBOT_PATTERN_REFRESH_INTERVAL', '1.0'))  # 0 checks on every reply
+RESPONSE_CACHE_SIZE = int(os.environ.get('PYBOT_RESPONSE_CACHE_SIZE', '1024'))
+CORPUS_FILE = os.environ.get('PYBOT_CORPUS_FILE', '')  # memory-mapped response snapshot; '' reads SQLite only
+MATCHER = os.environ.get('PYBOT_MATCHER', 'index')  # 'index' or 'tfidf'
+TFIDF_CANDIDATES = int(os.environ.get('PYBOT_TFIDF_CANDIDATES', '32'))
+SHARD_WORKERS = int(os.environ.get('PYBOT_SHARD_WORKERS', '0'))  # 0 or 1 scores in-process
+SHARD_THRESHOLD = int(os.environ.get('PYBOT_SHARD_THRESHOLD', '50000'))
+METRICS_ENABLED = os.environ.get('PYBOT_METRICS', '1') != '0'
+SERVER_WORKERS = int(os.environ.get('PYBOT_WORKERS', str(min(4, os.cpu_count() or 1))))
+SERVER_THREADS = int(os.environ.get('PYBOT_THREADS', '8'))
+EXEC_WORKERS = int(os.environ.get('PYBOT_EXEC_WORKERS', '2'))
+EXEC_CPU_SECONDS = int(os.environ.get('PYBOT_EXEC_CPU_SECONDS', '5'))
+EXEC_MEMORY_MB = int(os.environ.get('PYBOT_EXEC_MEMORY_MB', '256'))
+EXEC_MAX_OUTPUT = int(os.environ.get('PYBOT_EXEC_MAX_OUTPUT', str(256 * 1024)))
+STREAM_CHUNK_SIZE = int(os.environ.get('PYBOT_STREAM_CHUNK_SIZE', '4096'))
+TOP_K_MAX = int(os.environ.get('PYBOT_TOP_K_MAX', '20'))
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('PYBOT_ASYNC_MAX_CONNECTIONS', '10000'))
+ASYNC_IDLE_TIMEOUT = float(os.environ.get('PYBOT_ASYNC_IDLE_TIMEOUT', '75'))
+ASYNC_MAX_BODY = int(os.environ.get('PYBOT_ASYNC_MAX_BODY', str(64 * 1024 * 1024)))
+
+# (raw score, probability the reply is right) knots for calibrate_score, from
+# `python chatbot_backend.py --calibrate` on the built-in corpus
+SCORE_CALIBRATION = (
+    (0.625, 0.0), (0.675, 0.0), (0.725, 0.3), (0.775, 0.831), (0.825, 0.831),
+    (0.875, 0.931), (0.925, 0.931), (0.975, 0.931), (1.025, 0.931), (1.075, 0.933),
+)
+
+class Timer:
+    """Context manager that records its duration into a Metrics histogram"""
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class NullTimer:
+    """Stand-in for Timer when metrics are disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class Metrics:
+    """Prometheus-style counters and latency histograms
+
+    When disabled every call returns immediately (stage() hands back a shared
+    no-op timer), so instrumentation can stay in the hot path.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    HELP = {
+        'pybot_stage_seconds': 'Time spent in each stage of the chat pipeline',
+        'pybot_request_seconds': 'HTTP request latency by endpoint',
+        'pybot_db_seconds': 'SQLite operation latency',
+        'pybot_requests_total': 'HTTP requests by endpoint and status code',
+        'pybot_replies_total': 'Chat replies by source',
+        'pybot_code_checks_total': 'Code checks by source (sandbox run or cache)',
+        'pybot_streams_total': 'Streamed chat replies by outcome',
+    }
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.in_flight = 0
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # One slot per bucket plus +Inf, then the running sum
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels) if self.enabled else NULL_TIMER
+
+    def stage(self, stage):
+        """Time one stage of the chat pipeline"""
+        return self.timer('pybot_stage_seconds', stage=stage) if self.enabled else NULL_TIMER
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self, gauges=()):
+        """Text exposition format; gauges is an iterable of (name, help, labels, value)"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+
+        lines = []
+        seen = set()
+
+        def header(name, kind, help_text=None):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {help_text or self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {histogram[-1]:.6f}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {cumulative}")
+
+        for name, help_text, labels, value in gauges:
+            header(name, 'gauge', help_text)
+            lines.append(f"{name}{self.format_labels(sorted(labels.items()))} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class Database:
+    """Pool of persistent SQLite connections in WAL mode
+
+    Connections are opened once and reused across requests so SQLite's
+    per-connection statement cache keeps our queries prepared. WAL lets readers
+    run alongside the conversation writer instead of queueing behind it.
+    """
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE, busy_timeout=5.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.pool = queue.LifoQueue()
+        self.pid = os.getpid()
+        self.orphans = []
+
+    def connect(self):
+        """Open a new connection with our pragmas applied"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,  # pooled connections move between threads
+            cached_statements=256
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, no fsync per commit
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def checkout(self):
+        if os.getpid() != self.pid:
+            # Forked child: never reuse (or close) the parent's handles
+            self.pid = os.getpid()
+            while True:
+                try:
+                    self.orphans.append(self.pool.get_nowait())
+                except queue.Empty:
+                    break
+
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def checkin(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.pool.qsize() < self.pool_size:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection for the duration of the block"""
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection and commit on success, roll back on error"""
+        with self.connection() as conn:
+            with conn:
+                yield conn
+
+    def close(self):
+        """Close every idle pooled connection"""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+class ConversationLogger:
+    """Background writer that batches conversation inserts off the request path
+
+    Records are queued by the request thread and written by a single writer
+    thread with executemany, either once batch_size records are waiting or
+    every flush_interval seconds. When the queue is full a record is dropped
+    (and counted) unless block_timeout allows the caller to wait briefly.
+    An optional maintenance callable (e.g. conversation retention) runs on
+    the same thread every maintenance_interval seconds, between batches.
+    """
+
+    INSERT = "INSERT INTO conversations (input_text, response_text, confidence, timestamp) VALUES (?, ?, ?, ?)"
+    STOP = object()
+
+    def __init__(self, db, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, block_timeout=LOG_BLOCK_TIMEOUT,
+                 maintenance=None, maintenance_interval=RETENTION_INTERVAL, on_write=None):
+        self.db = db
+        self.on_write = on_write
+        self.maintenance = maintenance
+        self.maintenance_interval = maintenance_interval
+        self.next_maintenance = 0.0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.start()
+        atexit.register(self.close)
+
+    @property
+    def depth(self):
+        """Number of records waiting to be written"""
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+    def start(self):
+        with self.lock:
+            # Threads do not survive a fork, so this also restarts the writer in a child
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='conversation-logger', daemon=True)
+                self.thread.start()
+
+    def log(self, input_text, response_text, confidence):
+        """Queue one conversation record; returns False if it had to be dropped"""
+        if not self.thread.is_alive():
+            self.start()
+
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        record = (input_text, response_text, confidence, timestamp)
+        try:
+            if self.block_timeout > 0:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            self.maintain()
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is self.STOP:
+                    stopping = True
+                    self.queue.task_done()
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self.write(batch)
+
+    def maintain(self):
+        """Run the maintenance callable if it is due"""
+        if self.maintenance is None or time.monotonic() < self.next_maintenance:
+            return
+        self.next_maintenance = time.monotonic() + self.maintenance_interval
+        try:
+            self.maintenance()
+        except sqlite3.Error as e:
+            print(f"Conversation maintenance error: {e}")
+
+    def log_many(self, records):
+        """Write (input, response, confidence) records now, in one transaction
+
+        Used for batch requests, which should neither flood the queue nor
+        have records dropped when it is full.
+        """
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(input_text, response_text, confidence, timestamp)
+                for input_text, response_text, confidence in records]
+        try:
+            with metrics.timer('pybot_db_seconds', operation='log_conversations'):
+                with self.db.transaction() as conn:
+                    conn.executemany(self.INSERT, rows)
+            with self.lock:
+                self.written += len(rows)
+            if self.on_write is not None:
+                self.on_write(len(rows))
+            return True
+        except sqlite3.Error as e:
+            with self.lock:
+                self.failed += len(rows)
+            print(f"Conversation log error: {e}")
+            return False
+
+    def write(self, batch):
+        try:
+            with metrics.timer('pybot_db_seconds', operation='log_conversations'):
+                with self.db.transaction() as conn:
+                    conn.executemany(self.INSERT, batch)
+            with self.lock:
+                self.written += len(batch)
+            if self.on_write is not None:
+                self.on_write(len(batch))
+        except sqlite3.Error as e:
+            with self.lock:
+                self.failed += len(batch)
+            print(f"Conversation log error: {e}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def flush(self):
+        """Block until every queued record has been written"""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Write out everything still queued and stop the writer thread"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(self.STOP)
+            self.thread.join()
+
+# Runs inside each sandbox worker process (python -I -c). Reads one JSON job per
+# line on stdin, executes it with restricted builtins and writes one JSON result
+# line to stdout. CPU and memory limits are enforced with rlimits where available.
+SANDBOX_WORKER = """
+import builtins, io, json, sys
+try:
+    import resource
+except ImportError:
+    resource = None
+
+allowed, cpu_seconds, memory_bytes, max_output = json.loads(sys.argv[1])
+safe_builtins = {name: getattr(builtins, name) for name in allowed}
+channel = sys.stdout
+
+class CappedOutput(io.StringIO):
+    # Keeps the first max_output characters and counts the rest
+    dropped = 0
+
+    def write(self, text):
+        room = max(0, max_output - self.tell())
+        if len(text) > room:
+            self.dropped += len(text) - room
+            super().write(text[:room])
+        else:
+            super().write(text)
+        return len(text)
+
+if resource is not None and memory_bytes > 0:
+    resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+for line in sys.stdin:
+    code = json.loads(line)['code']
+    if resource is not None and cpu_seconds > 0:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime + cpu_seconds) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+
+    stdout, stderr = CappedOutput(), CappedOutput()
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        exec(code, {'__builtins__': dict(safe_builtins)})
+        result = {'success': True}
+    except Exception as e:
+        result = {'success': False, 'error_type': type(e).__name__, 'error': str(e)}
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+    result['output'] = stdout.getvalue()
+    result['stderr'] = stderr.getvalue()
+    result['truncated'] = stdout.dropped
+    channel.write(json.dumps(result) + '\\n')
+    channel.flush()
+"""
+
+class SandboxWorker:
+    """One long-lived sandbox process and the thread reading its replies"""
+
+    def __init__(self, allowed_builtins, cpu_seconds, memory_mb, max_output):
+        limits = json.dumps([list(allowed_builtins), cpu_seconds, memory_mb * 1024 * 1024, max_output])
+        self.process = subprocess.Popen(
+            [sys.executable, '-I', '-c', SANDBOX_WORKER, limits],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8'
+        )
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_replies, daemon=True).start()
+
+    def read_replies(self):
+        for line in self.process.stdout:
+            self.replies.put(line)
+        self.replies.put(None)  # EOF - the worker exited or was killed
+
+    def run(self, code, timeout):
+        """Execute code; returns the result dict, or None if the worker died.
+        Raises queue.Empty if no reply arrives within timeout seconds."""
+        try:
+            self.process.stdin.write(json.dumps({'code': code}) + '\n')
+            self.process.stdin.flush()
+        except OSError:
+            return None
+
+        reply = self.replies.get(timeout=timeout)
+        return json.loads(reply) if reply is not None else None
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+class CodeExecutionPool:
+    """Pool of pre-started sandbox processes for running user code
+
+    Each job runs in its own process with captured (and size-capped) output, a
+    wall-clock timeout and CPU/memory rlimits. A worker that times out or crashes is killed and
+    replaced, so a runaway snippet never ties up a server thread.
+    """
+
+    def __init__(self, allowed_builtins, size=EXEC_WORKERS, cpu_seconds=EXEC_CPU_SECONDS,
+                 memory_mb=EXEC_MEMORY_MB, max_output=EXEC_MAX_OUTPUT):
+        self.allowed_builtins = tuple(allowed_builtins)
+        self.size = size
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_output = max_output
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+        self.pid = os.getpid()
+        self.timeouts = 0
+        self.crashes = 0
+        atexit.register(self.close)
+
+    def spawn(self):
+        return SandboxWorker(self.allowed_builtins, self.cpu_seconds, self.memory_mb, self.max_output)
+
+    def start(self):
+        """Start the worker processes (done lazily on first use)"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked child: the inherited workers belong to the parent
+                self.pid = os.getpid()
+                self.idle = queue.Queue()
+                self.started = False
+            if not self.started:
+                for _ in range(self.size):
+                    self.idle.put(self.spawn())
+                self.started = True
+
+    def execute(self, code, timeout):
+        """Run code in a worker; returns the worker's result dict, or an error
+        dict with error_type TimeoutError/WorkerError if the worker had to be killed"""
+        if not self.started or self.pid != os.getpid():
+            self.start()
+
+        deadline = time.monotonic() + timeout
+        try:
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            return {'success': False, 'error_type': 'TimeoutError', 'output': '',
+                    'error': f'No free execution worker within {timeout} seconds'}
+
+        try:
+            result = worker.run(code, max(0.01, deadline - time.monotonic()))
+            if result is None:
+                self.crashes += 1
+                worker.kill()
+                worker = self.spawn()
+                return {'success': False, 'error_type': 'WorkerError', 'output': '',
+                        'error': 'Execution stopped - CPU or memory limit exceeded'}
+            return result
+        except queue.Empty:
+            self.timeouts += 1
+            worker.kill()
+            worker = self.spawn()
+            return {'success': False, 'error_type': 'TimeoutError', 'output': '',
+                    'error': f'Code execution exceeded {timeout} seconds'}
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        """Stop all idle workers"""
+        if self.pid != os.getpid():
+            return
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
 class PythonErrorChecker:
     """Python code error checker and analyzer"""
 
+    # Builtins available to executed user code
+    SAFE_BUILTINS = (
+        'print', 'len', 'str', 'int', 'float', 'list', 'dict', 'tuple', 'set', 'range',
+        'enumerate', 'zip', 'sum', 'max', 'min', 'abs', 'round', 'sorted', 'reversed'
+    )
+
     def __init__(self):
         self.common_errors = {
             'SyntaxError': 'Syntax error - check for missing colons, parentheses, or quotes',
@@ -38,14 +666,22 @@ class PythonErrorChecker:
             'AttributeError': 'Object has no attribute - check method/property names',
             'ImportError': 'Module import failed - check module name and installation',
             'ZeroDivisionError': 'Division by zero - add condition to check denominator',
-            'FileNotFoundError': 'File not found - check file path and existence'
+            'FileNotFoundError': 'File not found - check file path and existence',
+            'TimeoutError': 'Execution timed out - check for infinite loops or very long-running code',
+            'MemoryError': 'Out of memory - avoid building huge lists or strings',
+            'WorkerError': 'Execution stopped - the code used too much CPU time or memory'
         }
+        self.executor = CodeExecutionPool(self.SAFE_BUILTINS)
 
     def check_syntax(self, code):
         """Check Python code for syntax errors"""
+        return self.parse(code)[0]
+
+    def parse(self, code):
+        """Parse code once; returns (syntax result, AST or None)"""
         try:
-            ast.parse(code)
-            return {'valid': True, 'message': 'Code syntax is valid!'}
+            tree = ast.parse(code)
+            return {'valid': True, 'message': 'Code syntax is valid!'}, tree
         except SyntaxError as e:
             return {
                 'valid': False,
@@ -54,38 +690,56 @@ class PythonErrorChecker:
                 'line': e.lineno,
                 'column': e.offset,
                 'suggestion': self.get_syntax_suggestion(str(e))
-            }
+            }, None
         except Exception as e:
             return {
                 'valid': False,
                 'error_type': type(e).__name__,
                 'message': str(e),
                 'suggestion': 'Check your code structure and syntax'
-            }
+            }, None
+
+    def analyze_code(self, code, tree=None):
+        """Analyze code for potential issues and improvements
+
+        Pass the AST from parse() to avoid parsing again. With a valid AST the
+        Python 2 print and missing-indentation heuristics are skipped (the code
+        parsed, so neither problem can be present) and 'import *' is found
+        from ImportFrom nodes instead of by substring.
+        """
+        if tree is None:
+            tree = self.parse(code)[1]
 
-    def analyze_code(self, code):
-        """Analyze code for potential issues and improvements"""
         issues = []
         suggestions = []
 
+        if tree is not None:
+            complexity, import_star_lines = self.walk_tree(tree)
+        else:
+            complexity, import_star_lines = self.keyword_complexity(code), set()
+
         lines = code.split('\n')
 
         for i, line in enumerate(lines, 1):
             line_stripped = line.strip()
 
             # Check for common issues
-            if line_stripped.startswith('print '):
+            if tree is None and line_stripped.startswith('print '):
                 issues.append(f"Line {i}: Use print() function, not print statement (Python 3)")
 
             if '==' in line and line.count('=') > line.count('==') * 2:
                 issues.append(f"Line {i}: Possible assignment (=) instead of comparison (==)")
 
-            if line_stripped.endswith(':') and not line.startswith(' ') and not line.startswith('\t'):
+            if tree is None and line_stripped.endswith(':') and not line.startswith(' ') and not line.startswith('\t'):
                 next_line = lines[i] if i < len(lines) else ''
                 if next_line and not (next_line.startswith(' ') or next_line.startswith('\t')):
                     issues.append(f"Line {i+1}: Missing indentation after colon")
 
-            if 'import' in line and '*' in line:
+            if tree is not None:
+                star_import = i in import_star_lines
+            else:
+                star_import = 'import' in line and '*' in line
+            if star_import:
                 suggestions.append(f"Line {i}: Avoid 'import *' - import specific functions instead")
 
             if len(line) > 79:
@@ -95,7 +749,7 @@ class PythonErrorChecker:
             'issues': issues,
             'suggestions': suggestions,
             'line_count': len(lines),
-            'complexity': self.calculate_complexity(code)
+            'complexity': self.complexity_rating(complexity)
         }
 
     def get_syntax_suggestion(self, error_msg):
@@ -122,11 +776,40 @@ class PythonErrorChecker:
         else:
             return "Check Python syntax rules and fix the highlighted error"
 
-    def calculate_complexity(self, code):
-        """Calculate basic code complexity"""
-        complexity_keywords = ['if', 'elif', 'else', 'for', 'while', 'try', 'except', 'with']
-        complexity = sum(code.count(keyword) for keyword in complexity_keywords)
-
+    # Nodes that add a decision point to the cyclomatic complexity
+    BRANCH_NODES = (ast.If, ast.IfExp, ast.For, ast.AsyncFor, ast.While, ast.ExceptHandler,
+                    ast.With, ast.AsyncWith, ast.Assert, ast.comprehension,
+                    getattr(ast, 'match_case', ast.If))  # match/case needs Python 3.10+
+    BRANCH_KEYWORDS = re.compile(r'\b(?:if|elif|for|while|except|with|and|or)\b')
+
+    def walk_tree(self, tree):
+        """One walk over the AST: (cyclomatic complexity, lines with 'import *')"""
+        complexity = 1
+        import_star_lines = set()
+        for node in ast.walk(tree):
+            if isinstance(node, self.BRANCH_NODES):
+                complexity += 1
+                if isinstance(node, ast.comprehension):
+                    complexity += len(node.ifs)
+            elif isinstance(node, ast.BoolOp):
+                complexity += len(node.values) - 1
+            elif isinstance(node, ast.ImportFrom) and any(alias.name == '*' for alias in node.names):
+                import_star_lines.add(node.lineno)
+        return complexity, import_star_lines
+
+    def keyword_complexity(self, code):
+        """Approximate complexity of unparseable code from branching keywords"""
+        return 1 + len(self.BRANCH_KEYWORDS.findall(code))
+
+    def calculate_complexity(self, code, tree=None):
+        """Rate cyclomatic complexity (1 + decision points) as Low/Medium/High"""
+        if tree is None:
+            tree = self.parse(code)[1]
+        if tree is not None:
+            return self.complexity_rating(self.walk_tree(tree)[0])
+        return self.complexity_rating(self.keyword_complexity(code))
+
+    def complexity_rating(self, complexity):
         if complexity <= 5:
             return 'Low'
         elif complexity <= 10:
@@ -134,6 +817,44 @@ class PythonErrorChecker:
         else:
             return 'High'
 
+    # Default reprs of functions, lambdas and instances, e.g. <function f at 0x7f...>
+    OBJECT_ADDRESS = re.compile(r' at 0x[0-9a-fA-F]+>')
+    SET_OPERATORS = (ast.Sub, ast.BitAnd, ast.BitOr, ast.BitXor)
+
+    def is_deterministic(self, tree, execution_result):
+        """Whether re-running the code would give the same results
+
+        Timeouts and killed workers depend on load; set iteration order
+        (including set operators on dict views), hash() and __hash__()
+        change between sandbox processes because of hash randomization; and
+        id() values and printed object reprs contain memory addresses.
+        """
+        if execution_result is not None:
+            if not execution_result['success'] \
+                    and execution_result['error'].startswith(('TimeoutError:', 'WorkerError:')):
+                return False
+            if self.OBJECT_ADDRESS.search(execution_result['output']) \
+                    or self.OBJECT_ADDRESS.search(execution_result['error']):
+                return False
+        if tree is not None:
+            for node in ast.walk(tree):
+                if isinstance(node, (ast.Set, ast.SetComp)):
+                    return False
+                if isinstance(node, ast.Name) and node.id in ('set', 'id', 'hash'):
+                    return False
+                if isinstance(node, ast.Attribute) and node.attr == '__hash__':
+                    return False
+                # d.keys() - e.keys(), d.items() & ... return sets
+                if isinstance(node, ast.BinOp) and isinstance(node.op, self.SET_OPERATORS) \
+                        and any(self.is_view_call(operand) for operand in (node.left, node.right)):
+                    return False
+        return True
+
+    @staticmethod
+    def is_view_call(node):
+        return isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+            and node.func.attr in ('keys', 'items')
+
     def safe_execute(self, code, timeout=5):
         """Safely execute Python code with restrictions"""
         # Restricted imports and functions for security
@@ -148,106 +869,1371 @@ class PythonErrorChecker:
                     'suggestion': 'Code contains potentially unsafe operations'
                 }
 
-        # Capture output
-        old_stdout = sys.stdout
-        old_stderr = sys.stderr
-        stdout_capture = StringIO()
-        stderr_capture = StringIO()
-
-        try:
-            sys.stdout = stdout_capture
-            sys.stderr = stderr_capture
-
-            # Execute code in restricted environment
-            exec_globals = {
-                '__builtins__': {
-                    'print': print,
-                    'len': len,
-                    'str': str,
-                    'int': int,
-                    'float': float,
-                    'list': list,
-                    'dict': dict,
-                    'tuple': tuple,
-                    'set': set,
-                    'range': range,
-                    'enumerate': enumerate,
-                    'zip': zip,
-                    'sum': sum,
-                    'max': max,
-                    'min': min,
-                    'abs': abs,
-                    'round': round,
-                    'sorted': sorted,
-                    'reversed': reversed
-                }
-            }
-
-            exec(code, exec_globals)
-
-            output = stdout_capture.getvalue()
-            error_output = stderr_capture.getvalue()
+        # Run in a sandbox worker process with real time, CPU and memory limits
+        result = self.executor.execute(code, timeout)
 
+        if result['success']:
             return {
                 'success': True,
-                'output': output,
-                'error': error_output,
+                'output': result['output'],
+                'truncated': result.get('truncated', 0),
+                'error': result['stderr'],
                 'suggestion': 'Code executed successfully!'
             }
 
-        except Exception as e:
-            error_type = type(e).__name__
-            error_msg = str(e)
+        error_type = result['error_type']
+        return {
+            'success': False,
+            'error': f"{error_type}: {result['error']}",
+            'output': result['output'],
+            'truncated': result.get('truncated', 0),
+            'suggestion': self.common_errors.get(error_type, 'Check the error message and fix the issue')
+        }
 
-            return {
-                'success': False,
-                'error': f"{error_type}: {error_msg}",
-                'output': stdout_capture.getvalue(),
-                'suggestion': self.common_errors.get(error_type, 'Check the error message and fix the issue')
-            }
+class ResponseCache:
+    """Thread-safe LRU cache with a time-to-live for chat replies
+
+    clear() bumps a generation number; put() calls made with an older
+    generation are ignored so a reply computed before /api/train changed the
+    patterns can never be cached after the invalidation.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, e.g. after the pattern set changed"""
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
 
-        finally:
-            sys.stdout = old_stdout
-            sys.stderr = old_stderr
+class StatsCounters:
+    """In-process totals behind /api/stats
+
+    Bumped as conversations are written and patterns are trained, and
+    reconciled with the rollup tables every reconcile_interval seconds, which
+    also picks up writes from other worker processes. snapshot() re-renders
+    the JSON body and its ETag only after something changed.
+    """
+
+    def __init__(self, db, reconcile_interval=STATS_RECONCILE_INTERVAL):
+        self.db = db
+        self.reconcile_interval = reconcile_interval
+        self.lock = threading.Lock()
+        self.conversations = 0
+        self.patterns = 0
+        self.categories = {}
+        self.next_reconcile = 0.0
+        self.rendered = None
+
+    def reconcile(self):
+        """Reload the totals from the database rollups"""
+        with metrics.timer('pybot_db_seconds', operation='stats'), self.db.connection() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM counters"))
+            categories = dict(conn.execute("SELECT category, count FROM category_counts WHERE count > 0"))
+
+        with self.lock:
+            self.next_reconcile = time.monotonic() + self.reconcile_interval
+            totals = (counters.get('conversations', 0), counters.get('patterns', 0), categories)
+            if totals != (self.conversations, self.patterns, self.categories):
+                self.conversations, self.patterns, self.categories = totals
+                self.rendered = None
+
+    def add_conversations(self, count):
+        with self.lock:
+            self.conversations += count
+            self.rendered = None
+
+    def add_pattern(self, category):
+        with self.lock:
+            self.patterns += 1
+            self.categories[category] = self.categories.get(category, 0) + 1
+            self.rendered = None
+
+    def snapshot(self):
+        """Return (JSON body, ETag) for the current totals"""
+        if time.monotonic() >= self.next_reconcile:
+            self.reconcile()
+
+        with self.lock:
+            if self.rendered is None:
+                body = json.dumps({
+                    'total_conversations': self.conversations,
+                    'total_patterns': self.patterns,
+                    'categories': self.categories
+                }, sort_keys=True)
+                self.rendered = (body, hashlib.sha1(body.encode('utf-8')).hexdigest()[:20])
+            return self.rendered
+
+class CodeCheckCache:
+    """Content-addressed cache of code-check results
+
+    Keyed by a SHA-256 of the extracted code, so a snippet pasted again skips
+    the syntax check, analysis and sandbox run. The stored results do not
+    depend on the reply style (styling only changes how they are formatted),
+    so one entry serves every style. Bounded by entry count and by the
+    approximate size of the stored results; with a database it also persists
+    entries in the code_checks table so they survive restarts.
+    """
+
+    # Bump when the checker's results change so persisted entries are ignored
+    VERSION = 3
+
+    def __init__(self, db=None, max_entries=CODE_CACHE_SIZE, max_bytes=CODE_CACHE_MAX_BYTES):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.puts = 0
+
+    def key(self, code):
+        return hashlib.sha256(f"{self.VERSION}\0{code}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached (syntax, analysis, execution) results for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        if self.db is not None and self.max_entries > 0:
+            with self.db.connection() as conn:
+                row = conn.execute("SELECT result FROM code_checks WHERE digest = ?", (key,)).fetchone()
+            if row is not None:
+                value = tuple(json.loads(row[0]))
+                self.remember(key, value, len(row[0]))
+                with self.lock:
+                    self.hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        encoded = json.dumps(value)
+        if not self.remember(key, value, len(encoded)):
+            return
+
+        if self.db is not None:
+            with self.db.transaction() as conn:
+                conn.execute("INSERT OR REPLACE INTO code_checks (digest, result) VALUES (?, ?)", (key, encoded))
+                self.puts += 1
+                if self.puts % 100 == 0:
+                    # Keep the table to roughly the in-memory bound
+                    conn.execute(
+                        "DELETE FROM code_checks WHERE rowid <= (SELECT MAX(rowid) FROM code_checks) - ?",
+                        (self.max_entries,)
+                    )
+
+    def remember(self, key, value, size):
+        """Store value in memory; returns False if it is too large to cache"""
+        size += len(key)
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.db is not None:
+            with self.db.transaction() as conn:
+                conn.execute("DELETE FROM code_checks")
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_entries': self.max_entries,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'persistent': self.db is not None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class CorpusFile:
+    """Read-only, memory-mapped snapshot of response bodies keyed by pattern id
+
+    Layout: magic, a header of int64 (rows, pattern count, edit count, max
+    id), the UTF-8 bodies back to back, then the sorted ids and the body
+    offsets as int64 arrays. Lookups bisect the mapped id array, so nothing
+    but the pages actually read is loaded, and every process that maps the
+    file shares one page-cache copy. The counts and max id identify the
+    state of the patterns table the snapshot was written from.
+    """
+
+    MAGIC = b'PYBOTRC1'
+    HEADER = struct.Struct('<4q')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        start = len(self.MAGIC) + self.HEADER.size
+        if len(self.map) < start or self.map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f'{path} is not a response corpus file')
+        count, patterns, edits, max_id = self.HEADER.unpack_from(self.map, len(self.MAGIC))
+        self.fingerprint = (patterns, edits, max_id)
+        self.blob = start
+        tables = len(self.map) - 8 * (2 * count + 1)
+        if tables < start:
+            raise ValueError(f'{path} is truncated')
+        view = memoryview(self.map)
+        self.ids = view[tables:tables + 8 * count].cast('q')
+        self.offsets = view[tables + 8 * count:].cast('q')
+
+    @classmethod
+    def write(cls, path, rows, fingerprint):
+        """Write (id, body) rows, in id order, atomically to path"""
+        ids, offsets = array('q'), array('q', [0])
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(cls.MAGIC + cls.HEADER.pack(0, *fingerprint))
+            for row_id, body in rows:
+                data = body.encode('utf-8')
+                f.write(data)
+                ids.append(row_id)
+                offsets.append(offsets[-1] + len(data))
+            f.write(ids.tobytes())
+            f.write(offsets.tobytes())
+            f.seek(len(cls.MAGIC))
+            f.write(cls.HEADER.pack(len(ids), *fingerprint))
+        os.replace(tmp, path)
+        return len(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, row_id):
+        """Body of row_id, or None if the snapshot does not have it"""
+        i = bisect.bisect_left(self.ids, row_id)
+        if i == len(self.ids) or self.ids[i] != row_id:
+            return None
+        return self.map[self.blob + self.offsets[i]:self.blob + self.offsets[i + 1]].decode('utf-8')
+
+class ResponseStore:
+    """Response bodies by pattern id, fetched only for the pattern that won
+
+    The pattern index holds just pattern keys and ids; a reply reads its one
+    body by primary key through a small LRU. With PYBOT_CORPUS_FILE set, the
+    bodies come from a shared memory-mapped CorpusFile instead, and rows
+    added after it was written fall back to SQLite. rendered() memoizes
+    derived text, such as styled replies, in the same LRU. sync() runs
+    whenever the index is rebuilt: it drops cached entries and rewrites a
+    stale snapshot. refresh() switches to a snapshot another worker wrote,
+    so every worker maps the same file again.
+    """
+
+    def __init__(self, db, corpus_path=CORPUS_FILE, max_entries=RESPONSE_CACHE_SIZE):
+        self.db = db
+        self.corpus_path = corpus_path
+        self.corpus = None
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.corpus_reads = 0
+
+    def get(self, row_id):
+        """Body of the pattern row, or None if it no longer exists"""
+        with self.lock:
+            body = self.entries.get(row_id)
+            if body is not None:
+                self.entries.move_to_end(row_id)
+                self.hits += 1
+                return body
+            self.misses += 1
+            generation = self.generation
+
+        corpus = self.corpus
+        body = corpus.get(row_id) if corpus is not None else None
+        if body is not None:
+            self.corpus_reads += 1
+            return body
+
+        with metrics.timer('pybot_db_seconds', operation='response'), self.db.connection() as conn:
+            row = conn.execute("SELECT response FROM patterns WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            return None
+
+        self.remember(row_id, row[0], generation)
+        return row[0]
+
+    def rendered(self, row_id, variant, render):
+        """render(body) for the row, computed once per (row_id, variant); None if the row is gone"""
+        key = (row_id, variant)
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return text
+            generation = self.generation
+
+        body = self.get(row_id)
+        if body is None:
+            return None
+        text = render(body)
+        self.remember(key, text, generation)
+        return text
+
+    def remember(self, key, text, generation):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            # A sync() since the read may have changed the row; don't cache it then
+            if generation == self.generation:
+                self.entries[key] = text
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+    @staticmethod
+    def fingerprint(conn):
+        counters = dict(conn.execute("SELECT name, value FROM counters WHERE name IN ('patterns', 'pattern_edits')"))
+        max_id = conn.execute("SELECT MAX(id) FROM patterns").fetchone()[0] or 0
+        return counters.get('patterns', 0), counters.get('pattern_edits', 0), max_id
+
+    def sync(self):
+        """Forget cached bodies and make sure the corpus snapshot is current"""
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+        if not self.corpus_path:
+            return
+
+        with self.db.connection() as conn:
+            # One read transaction, so the rows match the fingerprint
+            conn.execute("BEGIN")
+            fingerprint = self.fingerprint(conn)
+            if self.corpus is not None and self.corpus.fingerprint == fingerprint:
+                return
+            try:
+                corpus = CorpusFile(self.corpus_path)
+            except (OSError, ValueError):
+                corpus = None
+            if corpus is None or corpus.fingerprint != fingerprint:
+                # Another worker may have written it already; os.replace keeps readers safe
+                CorpusFile.write(
+                    self.corpus_path,
+                    conn.execute("SELECT id, response FROM patterns ORDER BY id"),
+                    fingerprint
+                )
+                corpus = CorpusFile(self.corpus_path)
+
+        # The previous mapping is released once no reader holds it
+        self.corpus = corpus
+
+    def refresh(self, fingerprint):
+        """Map the snapshot file if another worker replaced it and it is still valid
+
+        Bodies only change through edits, so a snapshot written at the
+        current edit count holds the same bodies as the database; rows it
+        lacks are read from SQLite as usual.
+        """
+        if not self.corpus_path:
+            return
+        try:
+            stat = os.stat(self.corpus_path)
+        except OSError:
+            return
+        corpus = self.corpus
+        if corpus is not None and corpus.identity == (stat.st_dev, stat.st_ino):
+            return
+        try:
+            corpus = CorpusFile(self.corpus_path)
+        except (OSError, ValueError):
+            return
+        if corpus.fingerprint[1] == fingerprint[1]:
+            self.corpus = corpus
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'corpus_file': self.corpus_path or None,
+            'corpus_rows': len(self.corpus) if self.corpus is not None else 0,
+            'corpus_reads': self.corpus_reads
+        }
+
+class PatternIndex:
+    """Inverted trigram index over the patterns table for fast best-match lookup
+
+    Reproduces the scoring rules of get_response exactly (exact match, pattern in
+    input, input in pattern, SequenceMatcher fallback) but only scores patterns
+    that can possibly win instead of scanning the whole table on every request.
+
+    Rows are stored column-wise for a small per-pattern footprint: categories
+    and words are interned, positions live in flat arrays, and a pattern that
+    is already lowercase is not copied. The index is built once and then only
+    appended to; a change to existing rows builds a new index that replaces
+    this one, so readers never see a half-updated store.
+    """
+
+    NGRAM = 3
+
+    # Query normalization for the fallback pass: word tokens, and the shortest
+    # word that typo correction may touch
+    TOKEN = re.compile(r"[\w+#]+")
+    MIN_TYPO_LENGTH = 4
+
+    def __init__(self, rows=()):
+        self.patterns = []
+        self.response_ids = []   # patterns table ids; bodies are fetched by id when needed
+        self.categories = []
+        self.words = []       # distinct words of each pattern, split once at load time
+        self.vocabulary = set()   # lowercased word tokens of every pattern
+        self.stems = {}       # stem -> vocabulary word
+        self.deletes = {}     # vocabulary word minus one character -> word
+        self.lowered = []
+        self.gram_counts = array('I')
+        self.postings = {}    # trigram -> positions of patterns containing it (lists: iterated per query)
+        self.by_length = {}   # len(pattern) -> array of positions, for similarity bounds
+        self.short = []       # patterns shorter than one trigram
+        self.lock = threading.Lock()
+
+        for pattern, response_id, category in rows:
+            self.add(pattern, response_id, category)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def memory_usage(self):
+        """Approximate bytes held by the index: {'rows', 'search', 'total', 'per_pattern'}
+
+        rows covers the pattern, response id and category columns, search the
+        lookup structures built from them. Objects shared between entries
+        (interned strings, small ints, reused patterns) are counted once.
+        """
+        seen = set()
+
+        def deep(*roots):
+            total = 0
+            stack = list(roots)
+            while stack:
+                obj = stack.pop()
+                if id(obj) in seen:
+                    continue
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+                if isinstance(obj, dict):
+                    stack.extend(obj.keys())
+                    stack.extend(obj.values())
+                elif isinstance(obj, (list, tuple, set, frozenset)):
+                    stack.extend(obj)
+            return total
+
+        rows = deep(self.patterns, self.response_ids, self.categories)
+        search = deep(self.words, self.lowered, self.gram_counts, self.postings, self.by_length,
+                      self.short, self.vocabulary, self.stems, self.deletes)
+        return {
+            'rows': rows,
+            'search': search,
+            'total': rows + search,
+            'per_pattern': (rows + search) // max(1, len(self.patterns))
+        }
+
+    @classmethod
+    def grams(cls, text):
+        """Distinct character trigrams of text"""
+        return {text[i:i + cls.NGRAM] for i in range(len(text) - cls.NGRAM + 1)}
+
+    def add(self, pattern, response_id, category):
+        """Append a pattern; readers only see it once it is fully indexed"""
+        with self.lock:
+            pos = len(self.patterns)
+            grams = self.grams(pattern)
+            lowered = pattern.lower()
+            if lowered == pattern:
+                lowered = pattern
+
+            self.response_ids.append(response_id)
+            self.categories.append(sys.intern(category) if category is not None else None)
+            self.words.append(tuple(dict.fromkeys(map(sys.intern, pattern.split()))))
+            self.lowered.append(lowered)
+            for token in self.TOKEN.findall(lowered):
+                if token not in self.vocabulary:
+                    self.vocabulary.add(token)
+                    self.stems.setdefault(self.stem(token), token)
+                    if len(token) >= self.MIN_TYPO_LENGTH:
+                        for variant in self.deletions(token):
+                            self.deletes.setdefault(variant, token)
+            self.gram_counts.append(len(grams))
+
+            if grams:
+                for gram in grams:
+                    self.postings.setdefault(gram, []).append(pos)
+            else:
+                self.short.append(pos)
+            by_length = self.by_length.get(len(lowered))
+            if by_length is None:
+                by_length = self.by_length[len(lowered)] = array('I')
+            by_length.append(pos)
+
+            # Publish last so concurrent searches never see a half-added row
+            self.patterns.append(pattern)
+
+    def score(self, pos, clean_input, user_words, matcher):
+        """Score one pattern exactly like the original linear scan did"""
+        pattern = self.patterns[pos]
+
+        if clean_input == pattern:
+            return 1.0
+        elif pattern in clean_input:
+            # Give higher score for longer, more specific patterns
+            score = 0.8 + (len(pattern) / max(len(clean_input), 10)) * 0.2
+
+            # Bonus for exact word matches
+            if user_words.issuperset(self.words[pos]):
+                score += 0.1
+            return score
+        elif clean_input in pattern:
+            return 0.7
+        else:
+            matcher.set_seq1(self.lowered[pos])
+            score = matcher.ratio()
+            return score if score >= 0.6 else 0
+
+    def best_match(self, clean_input):
+        """Return (score, pattern, response_id, category) for the best pattern, or None"""
+        return self.result(*self.best_position(clean_input))
+
+    def top_matches(self, clean_input, k):
+        """Up to k (score, pattern, response_id, category) results, best first"""
+        return [self.result(pos, score) for pos, score in self.top_positions(clean_input, k)]
+
+    def best_position(self, clean_input):
+        """Return (position, score) of the best pattern, or (None, 0)"""
+        top = self.top_positions(clean_input, 1)
+        return top[0] if top else (None, 0)
+
+    def top_positions(self, clean_input, k):
+        """Return up to k (position, score) pairs, best first, from one pass"""
+        count = len(self.patterns)
+        matcher = self.query_matcher(clean_input)
+        heap = []
+
+        if len(clean_input) < self.NGRAM:
+            # Too short to have trigrams - every pattern may contain it
+            self.rank_into(heap, k, clean_input, range(count), matcher)
+        else:
+            scored = self.substring_candidates(clean_input, count)
+            self.rank_into(heap, k, clean_input, scored, matcher)
+            self.scan_similar(heap, k, matcher, scored, count)
+        return self.ranked(heap)
+
+    def refine(self, clean_input, seeds, k=1, offset=0):
+        """Improve on the (position, score) pairs found elsewhere
+
+        Used by pattern shards: this index holds the patterns from global
+        position offset on, and the caller has already ranked the substring
+        candidates of all patterns into seeds.
+        """
+        count = len(self.patterns)
+        matcher = self.query_matcher(clean_input)
+        heap = [(score, -pos) for pos, score in seeds]
+        heapq.heapify(heap)
+
+        if len(clean_input) < self.NGRAM:
+            self.rank_into(heap, k, clean_input, range(count), matcher, offset)
+        else:
+            scored = self.substring_candidates(clean_input, count)
+            self.scan_similar(heap, k, matcher, scored, count, offset)
+        return self.ranked(heap)
+
+    def scan_similar(self, heap, k, matcher, scored, count, offset=0):
+        """Add the patterns outside scored, which can only match through
+        SequenceMatcher, to the top-k heap; positions are shifted by offset"""
+        # Their ratio is bounded by 2*min(len)/(len_a+len_b), so lengths that
+        # cannot beat the current k-th best are skipped
+        query_len = len(matcher.b)
+        floor = max(0.6, heap[0][0]) if len(heap) >= k else 0.6
+        low = int(floor * query_len / (2 - floor))
+        high = int((2 - floor) * query_len / floor) + 1
+        for length in range(low, high + 1):
+            for pos in self.by_length.get(length, ()):
+                if pos >= count or pos in scored:
+                    continue
+                matcher.set_seq1(self.lowered[pos])
+                if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                    continue
+                score = matcher.ratio()
+                if score >= 0.6:
+                    self.push(heap, k, pos + offset, score)
+                    if len(heap) >= k:
+                        floor = max(floor, heap[0][0])
+
+    @staticmethod
+    def stem(word):
+        """Light plural stemmer: lists -> list, classes -> class, libraries -> library"""
+        if len(word) > 4 and word.endswith('ies'):
+            return word[:-3] + 'y'
+        if len(word) > 4 and word.endswith(('sses', 'xes', 'ches', 'shes')):
+            return word[:-2]
+        if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+            return word[:-1]
+        return word
+
+    @staticmethod
+    def deletions(word):
+        return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+    def correct_token(self, token):
+        """Map a query token to the pattern word it most likely means"""
+        if token in self.vocabulary:
+            return token
+        stemmed = self.stems.get(self.stem(token))
+        if stemmed is not None:
+            return stemmed
+        for word in dict.fromkeys((token, self.stem(token))):
+            if len(word) < self.MIN_TYPO_LENGTH:
+                continue
+            # One extra, missing, swapped or replaced character
+            if word in self.deletes:
+                return self.deletes[word]
+            variants = sorted(self.deletions(word))
+            for variant in variants:
+                if variant in self.vocabulary:
+                    return variant
+            for variant in variants:
+                if variant in self.deletes:
+                    return self.deletes[variant]
+        return token
+
+    def normalize(self, clean_input):
+        """Tokenize the query once, dropping punctuation and mapping plurals and
+        single-character typos onto the pattern vocabulary"""
+        return ' '.join(self.correct_token(token) for token in self.TOKEN.findall(clean_input.lower()))
+
+    def query_matcher(self, clean_input):
+        """SequenceMatcher primed with the query, reused across patterns"""
+        matcher = SequenceMatcher(None)
+        matcher.set_seq2(clean_input.lower())
+        return matcher
+
+    def substring_candidates(self, clean_input, count):
+        """Positions that may match as a substring in either direction"""
+        # Count shared trigrams: a substring match in either direction needs
+        # every trigram of the shorter side to be present in the longer one
+        query_grams = self.grams(clean_input)
+        hits = {}
+        for gram in query_grams:
+            for pos in self.postings.get(gram, ()):
+                hits[pos] = hits.get(pos, 0) + 1
+
+        candidates = set()
+        for pos, shared in hits.items():
+            if pos < count and (shared == self.gram_counts[pos] or shared == len(query_grams)):
+                candidates.add(pos)
+        candidates.update(pos for pos in self.short if pos < count)
+        return candidates
+
+    @staticmethod
+    def push(heap, k, pos, score):
+        """Keep the k best (score, -position) entries in a min-heap"""
+        # Ties go to the earliest row, as with the in-order scan
+        if score <= 0.3:
+            return
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -pos))
+        elif score >= heap[0][0] and (score, -pos) > heap[0]:
+            heapq.heapreplace(heap, (score, -pos))
+
+    @staticmethod
+    def ranked(heap):
+        """Heap entries as (position, score) pairs, best first"""
+        return [(-neg_pos, score) for score, neg_pos in sorted(heap, reverse=True)]
+
+    def rank_into(self, heap, k, clean_input, positions, matcher, offset=0):
+        """Score positions with the full rules into the top-k heap"""
+        user_words = set(clean_input.split())
+        for pos in positions:
+            self.push(heap, k, pos + offset, self.score(pos, clean_input, user_words, matcher))
+
+    def rank(self, clean_input, positions, matcher, k=1):
+        """Score positions with the full rules; returns the top k (position, score) pairs"""
+        heap = []
+        self.rank_into(heap, k, clean_input, positions, matcher)
+        return self.ranked(heap)
+
+    def best_of(self, clean_input, positions, k=1):
+        """Top k matches among the given positions only"""
+        return [self.result(pos, score) for pos, score in self.rank(clean_input, positions, self.query_matcher(clean_input), k)]
+
+    def result(self, pos, score):
+        if pos is None:
+            return None
+        return score, self.patterns[pos], self.response_ids[pos], self.categories[pos]
+
+class TfidfMatcher:
+    """Character n-gram TF-IDF matcher scored in one batch with NumPy
+
+    Patterns are stored as a sparse, column-major TF-IDF matrix, so a query is
+    scored against every pattern with a single weighted bincount over the
+    columns of its n-grams. The best cosine candidates, together with the
+    index's substring candidates, are then rescored with the regular rules so
+    confidences keep their meaning. Queries too short for trigrams go to the
+    index directly.
+    """
+
+    def __init__(self, index, candidates=TFIDF_CANDIDATES):
+        self.index = index
+        self.candidates = candidates
+        self.count = len(index)
+
+        vocabulary = {}
+        rows, cols, counts = [], [], []
+        for pos in range(self.count):
+            for gram, n in self.ngrams(index.lowered[pos]).items():
+                rows.append(pos)
+                cols.append(vocabulary.setdefault(gram, len(vocabulary)))
+                counts.append(n)
+
+        self.vocabulary = vocabulary
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        weights = 1.0 + np.log(np.asarray(counts, dtype=np.float32))
+
+        document_frequency = np.bincount(cols, minlength=len(vocabulary))
+        self.idf = (np.log((self.count + 1) / (document_frequency + 1)) + 1.0).astype(np.float32)
+        weights *= self.idf[cols]
+
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=self.count))
+        weights /= np.maximum(norms, 1e-9)[rows]
+
+        # Column-major layout: the rows and weights of n-gram c live in
+        # [indptr[c], indptr[c + 1])
+        order = np.argsort(cols, kind='stable')
+        self.rows = rows[order]
+        self.weights = weights[order].astype(np.float32)
+        self.indptr = np.concatenate(([0], np.cumsum(document_frequency))).astype(np.int64)
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def ngrams(text):
+        """Counts of character bigrams and trigrams, padded at the word edges"""
+        padded = ' ' + text + ' '
+        grams = {}
+        for size in (2, 3):
+            for i in range(len(padded) - size + 1):
+                gram = padded[i:i + size]
+                grams[gram] = grams.get(gram, 0) + 1
+        return grams
+
+    def cosine_scores(self, clean_input):
+        """Cosine similarity of the query against every pattern"""
+        grams = {}
+        for gram, n in self.ngrams(clean_input.lower()).items():
+            col = self.vocabulary.get(gram)
+            if col is not None:
+                grams[col] = n
+        if not grams:
+            return None
+
+        cols = np.fromiter(grams.keys(), dtype=np.int64, count=len(grams))
+        query = (1.0 + np.log(np.fromiter(grams.values(), dtype=np.float32, count=len(grams)))) * self.idf[cols]
+        query /= np.linalg.norm(query)
+
+        starts, stops = self.indptr[cols], self.indptr[cols + 1]
+        spans = [slice(start, stop) for start, stop in zip(starts, stops)]
+        rows = np.concatenate([self.rows[span] for span in spans])
+        weights = np.concatenate([self.weights[span] * q for span, q in zip(spans, query)])
+        return np.bincount(rows, weights=weights, minlength=self.count)
+
+    def best_match(self, clean_input):
+        """Same contract as PatternIndex.best_match"""
+        top = self.top_matches(clean_input, 1)
+        return top[0] if top else None
+
+    def top_matches(self, clean_input, k):
+        """Same contract as PatternIndex.top_matches"""
+        if len(clean_input) < self.index.NGRAM or not self.count:
+            return self.index.top_matches(clean_input, k)
+
+        positions = self.index.substring_candidates(clean_input, self.count)
+        scores = self.cosine_scores(clean_input)
+        if scores is not None:
+            n = min(max(self.candidates, k), self.count)
+            top = np.argpartition(-scores, n - 1)[:n]
+            positions.update(int(pos) for pos in top if scores[pos] > 0)
+        return self.index.best_of(clean_input, positions, k)
+
+def shard_main():
+    """Entry point of a pattern shard process: JSON lines over stdin/stdout
+
+    The first line holds the shard's offset and patterns. Every later line is
+    [query, k, [[position, score], ...]] and is answered with the refined
+    top-k [[position, score], ...] in global positions.
+    """
+    shard = json.loads(sys.stdin.readline())
+    offset = shard['offset']
+    index = PatternIndex((pattern, None, None) for pattern in shard['patterns'])
+    sys.stdout.write('"ready"\n')
+    sys.stdout.flush()
+    for line in sys.stdin:
+        clean_input, k, seeds = json.loads(line)
+        sys.stdout.write(json.dumps(index.refine(clean_input, seeds, k, offset)) + '\n')
+        sys.stdout.flush()
+
+class ShardedMatcher:
+    """Scores a large pattern index in parallel across worker processes
+
+    The cheap substring candidates are ranked here first; that best match is
+    sent along with the query so every shard prunes its SequenceMatcher scan
+    as hard as the serial path does. The patterns are split into contiguous
+    shards, each indexed by its own process, so that scan runs outside this
+    process's GIL. Shards return the best (position, score) they can find,
+    and the winner is the highest score with ties going to the earliest
+    position - the same answer as the serial scan. Top-k queries work the
+    same way with each shard returning its k best. Patterns added after the
+    shards were built are scored in-process until the next rebuild.
+    """
+
+    COMMAND = "import sys; sys.path.insert(0, sys.argv[1]); import chatbot_backend; chatbot_backend.shard_main()"
+
+    def __init__(self, index, workers=SHARD_WORKERS):
+        self.index = index
+        self.count = len(index)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.shards = []
+
+        size = -(-self.count // workers)
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        for start in range(0, self.count, size):
+            process = subprocess.Popen(
+                [sys.executable, '-c', self.COMMAND, module_dir],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding='utf-8'
+            )
+            process.stdin.write(json.dumps({'offset': start, 'patterns': index.patterns[start:start + size]}) + '\n')
+            process.stdin.flush()
+            self.shards.append((start, process))
+
+        # The shards index their rows in parallel; wait until all are ready
+        for _, process in self.shards:
+            if not process.stdout.readline():
+                self.close()
+                raise RuntimeError('pattern shard process failed to start')
+
+    def __len__(self):
+        return len(self.index)
+
+    def best_match(self, clean_input):
+        """Same contract as PatternIndex.best_match"""
+        top = self.top_matches(clean_input, 1)
+        return top[0] if top else None
+
+    def top_matches(self, clean_input, k):
+        """Same contract as PatternIndex.top_matches"""
+        if os.getpid() != self.pid or not self.shards:
+            return self.index.top_matches(clean_input, k)
+
+        seeds = []
+        if len(clean_input) >= PatternIndex.NGRAM:
+            scored = self.index.substring_candidates(clean_input, self.count)
+            seeds = self.index.rank(clean_input, scored, self.index.query_matcher(clean_input), k)
+
+        query = json.dumps([clean_input, k, seeds]) + '\n'
+        try:
+            with self.lock:
+                for _, process in self.shards:
+                    process.stdin.write(query)
+                    process.stdin.flush()
+                replies = [json.loads(process.stdout.readline()) for _, process in self.shards]
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Pattern shard failed ({e}) - scoring in-process from now on")
+            self.close()
+            return self.index.top_matches(clean_input, k)
+
+        # Every shard starts from the same seeds, so merge on position
+        found = dict(seeds)
+        for reply in replies:
+            found.update(reply)
+        if len(self.index) > self.count:
+            tail = range(self.count, len(self.index))
+            found.update(self.index.rank(clean_input, tail, self.index.query_matcher(clean_input), k))
+
+        heap = []
+        for pos, score in found.items():
+            PatternIndex.push(heap, k, pos, score)
+        return [self.index.result(pos, score) for pos, score in PatternIndex.ranked(heap)]
+
+    def close(self):
+        """Stop the shard processes"""
+        shards, self.shards = self.shards, []
+        if os.getpid() != self.pid:
+            return
+        for _, process in shards:
+            try:
+                process.stdin.close()
+                process.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+
+def check_matcher_parity(bot):
+    """Compare the tfidf matcher's top-1 picks with the exact scorer on the
+    built-in corpus and common variations of it; returns True if they all agree"""
+    if np is None:
+        print("NumPy is not installed - the tfidf matcher is unavailable")
+        return False
+
+    index = bot.pattern_index
+    matcher = TfidfMatcher(index)
+    queries = []
+    for pattern in index.patterns:
+        queries += [pattern.lower(), f"how do i use {pattern}", f"{pattern} in python", pattern[:-1], pattern + 's']
+
+    mismatches = []
+    for query in queries:
+        query = query.lower().strip()
+        expected = index.best_match(query)
+        actual = matcher.best_match(query)
+        if expected != actual:
+            mismatches.append((query, expected and expected[1], actual and actual[1]))
+
+    for query, expected, actual in mismatches:
+        print(f"  {query!r}: exact={expected!r} tfidf={actual!r}")
+    print(f"Matcher parity: {len(queries) - len(mismatches)}/{len(queries)} top-1 matches agree")
+    return not mismatches
+
+def build_score_calibration(bot, seed=0):
+    """Estimate P(correct reply | raw score) on the loaded patterns
+
+    Queries are generated from every pattern (wrapped in common phrasings,
+    misspelled, truncated, pluralized, mixed with another pattern) and
+    labeled correct when the reply is the response row of a pattern they were
+    built from; off-topic queries can only be wrong. Accuracy per score bin,
+    made monotonic with pool-adjacent-violators, gives knots in the
+    SCORE_CALIBRATION format.
+    """
+    rng = random.Random(seed)
+    index = bot.pattern_index
+    off_topic = ('weather', 'recipe', 'football', 'holiday', 'movie', 'garden', 'music', 'coffee',
+                 'travel', 'birthday', 'painting', 'mountain', 'ocean', 'guitar', 'tomorrow', 'doctor')
+    samples = []
+
+    def sample(query, *responses):
+        query = bot.clean_input(query)
+        match = index.best_match(query)
+        if match:
+            samples.append((match[0], match[2] in responses))
+
+    for pattern, response in zip(index.patterns, index.response_ids):
+        lowered = pattern.lower()
+        for template in ('{}', 'what is {}', 'how do i use {} in python', 'explain {} please'):
+            sample(template.format(lowered), response)
+        if len(lowered) >= 4:
+            i = rng.randrange(1, len(lowered) - 1)
+            sample(lowered[:i] + lowered[i + 1:], response)
+            sample(lowered[:i - 1] + lowered[i] + lowered[i - 1] + lowered[i + 1:], response)
+        if ' ' in lowered:
+            sample(lowered.rsplit(' ', 1)[0], response)
+        sample(lowered + 's', response)
+        other = rng.randrange(len(index.patterns))
+        sample(f"{lowered} {index.patterns[other].lower()}", response, index.response_ids[other])
+        sample(f"{rng.choice(off_topic)} {lowered.split()[0]}", response)
+        for _ in range(3):
+            sample(' '.join(rng.sample(off_topic, rng.randint(1, 3))))
+
+    bins = [round(0.3 + 0.05 * i, 2) for i in range(17)]   # 0.30 .. 1.10
+    totals = [[0, 0] for _ in bins]
+    for score, correct in samples:
+        slot = min(len(bins) - 1, max(0, int(round((score - 0.3) / 0.05, 6))))
+        totals[slot][0] += correct
+        totals[slot][1] += 1
+
+    # Pool adjacent bins until accuracy never drops as the score rises
+    blocks = []
+    for edge, (hits, count) in zip(bins, totals):
+        if not count:
+            continue
+        blocks.append([hits, count, [edge]])
+        while len(blocks) > 1 and blocks[-2][0] / blocks[-2][1] > blocks[-1][0] / blocks[-1][1]:
+            hits, count, edges = blocks.pop()
+            blocks[-1][0] += hits
+            blocks[-1][1] += count
+            blocks[-1][2] += edges
+
+    # Knots sit at the bin centers
+    knots = tuple(
+        (round(edge + 0.025, 3), round(hits / count, 3))
+        for hits, count, edges in blocks
+        for edge in edges
+    )
+    return knots, len(samples)
+
+def calibrate_score(score, knots=None):
+    """Map a raw match score to an estimated probability that the reply is right
+
+    Raw scores are not comparable across rules (containment is a flat 0.7,
+    substring matches start at 0.8, similarity is a SequenceMatcher ratio), so
+    they are interpolated through the SCORE_CALIBRATION table.
+    """
+    knots = knots or SCORE_CALIBRATION
+    if score <= knots[0][0]:
+        return knots[0][1]
+    if score >= knots[-1][0]:
+        return knots[-1][1]
+    i = bisect.bisect_right(knots, (score, float('inf')))
+    (x0, y0), (x1, y1) = knots[i - 1], knots[i]
+    return round(y0 + (y1 - y0) * (score - x0) / (x1 - x0), 3)
+
+def training_format(filename='', mimetype=''):
+    """Guess the bulk import format ('jsonl' or 'csv') from a file name or MIME type"""
+    filename = (filename or '').lower()
+    if filename.endswith('.csv') or mimetype == 'text/csv':
+        return 'csv'
+    if filename.endswith(('.jsonl', '.ndjson', '.json')) or mimetype in ('application/x-ndjson', 'application/jsonl', 'application/json'):
+        return 'jsonl'
+    return None
+
+def read_training_rows(lines, fmt, report):
+    """Yield (pattern, response, category) rows from JSON-lines or CSV text
+
+    lines can be any iterable of text lines (an open file, a wrapped upload),
+    so large files are streamed rather than loaded. Rows without a pattern or
+    response are skipped and counted in report['skipped'], with the first few
+    reasons kept in report['errors'].
+    """
+    def skip(line_number, reason):
+        report['skipped'] += 1
+        if len(report['errors']) < 20:
+            report['errors'].append(f"Line {line_number}: {reason}")
+
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        if not reader.fieldnames or not {'pattern', 'response'} <= set(reader.fieldnames):
+            raise ValueError("CSV needs a header row with 'pattern' and 'response' columns")
+        records = ((reader.line_num, row) for row in reader)
+    else:
+        def parse_lines():
+            for line_number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    skip(line_number, f"invalid JSON ({e})")
+                    continue
+                if not isinstance(record, dict):
+                    skip(line_number, "expected a JSON object")
+                    continue
+                yield line_number, record
+        records = parse_lines()
+
+    for line_number, record in records:
+        pattern = str(record.get('pattern') or '').strip()
+        response = str(record.get('response') or '').strip()
+        category = str(record.get('category') or '').strip() or 'custom'
+        if not pattern or not response:
+            skip(line_number, "pattern and response are required")
+            continue
+        yield pattern, response, category
 
 class SmartChatBot:
     """A simple but effective chatbot using pattern matching and learning"""
 
-    def __init__(self):
-        self.db_path = 'pybot_conversations.db'
+    STYLES = ('balanced', 'detailed', 'concise', 'beginner')
+
+    # Instructions the frontend prepends for each style; stripped before matching
+    STYLE_PREFIX = re.compile('|'.join(re.escape(prefix) for prefix in (
+        'please provide a detailed, comprehensive explanation:',
+        'please provide a brief, concise answer:',
+        'please explain in beginner-friendly terms with simple examples:',
+        'please provide a detailed explanation:',
+        'please explain simply:'
+    )))
+
+    # Code detection and extraction, built once per process
+    CODE_FENCE = re.compile(r'```(?:python)?\s*(.*?)\s*```', re.DOTALL)
+    CODE_PREFIXES = ('def ', 'class ', 'import ', 'from ', 'if ', 'for ', 'while ', 'try:', 'print(')
+    # One-line messages without any of these are plain questions, not code
+    CODE_PUNCTUATION = re.compile(r'[\n`=()\[\]{}:]')
+    # Most common in code first, so detection can stop early
+    CODE_INDICATORS = (
+        '=', '()', 'print(', 'def ', 'return ', 'import ', 'in ', '[', ']', 'if ', 'for ',
+        'from ', 'class ', 'while ', 'try:', 'except:', '==', '!=', '+=', '-=', 'yield ', '{', '}',
+        'lambda ', 'with ', 'as ', 'not ', 'and ', 'or ', 'True', 'False', 'None'
+    )
+
+    # Style material, shared by every reply
+    DETAILED_ADDITIONS = {
+        'functions': "\n\n**Additional Details:**\n• Functions can have default parameters: def greet(name='World'): return f'Hello {name}'\n• Use *args for variable arguments: def sum_all(*args): return sum(args)\n• Use **kwargs for keyword arguments: def info(**kwargs): print(kwargs)\n• Functions are first-class objects and can be passed as arguments",
+        'lists': "\n\n**Advanced List Operations:**\n• List slicing: my_list[1:3] gets elements from index 1 to 2\n• List comprehensions: [x*2 for x in range(5) if x % 2 == 0]\n• Nested lists: matrix = [[1,2], [3,4]]\n• List methods: .count(), .index(), .copy(), .clear()",
+        'strings': "\n\n**String Advanced Features:**\n• String slicing: text[1:5] gets substring from index 1 to 4\n• Raw strings: r'C:\\path\\to\\file' (no escape sequences)\n• Multi-line strings: '''Line 1\nLine 2\nLine 3'''\n• String formatting: f'{name:>10}' (right-align in 10 chars)",
+        'loops': "\n\n**Loop Advanced Concepts:**\n• Loop with else: for/while loops can have else clause (runs if no break)\n• Nested loops: for i in range(3): for j in range(3): print(i, j)\n• Loop control: break (exit), continue (skip), pass (do nothing)\n• Enumerate: for i, value in enumerate(list) gives index and value",
+    }
+    DETAILED_DEFAULT = "\n\n**Pro Tip:** This is a fundamental Python concept. Practice with different examples to master it!"
+    CONCISE_CODE_HINTS = ('import', 'def', '=', 'print')
+    BEGINNER_INTROS = {
+        'functions': "🔧 **Functions** are like recipes in cooking - they take ingredients (parameters) and create something (return value). ",
+        'lists': "📝 **Lists** are like shopping lists - you can add items, remove items, and check what's in them. ",
+        'strings': "📄 **Strings** are just text - like words in a book. You can join them, split them, and change them. ",
+        'loops': "🔄 **Loops** are like doing the same task multiple times - like washing dishes one by one. ",
+        'variables': "📦 **Variables** are like labeled boxes where you store things for later use. ",
+        'dictionaries': "📚 **Dictionaries** are like phone books - you look up a name (key) to find a number (value). ",
+    }
+    BEGINNER_DEFAULT = "🐍 **Python Concept:** "
+    BEGINNER_SUFFIX = "\n\n💡 **Remember:** Start simple and practice! Every expert was once a beginner. Try typing this code in Python to see how it works."
+
+    def __init__(self, db_path=None, matcher=None):
+        self.db_path = db_path or DB_PATH
+        self.matcher_name = matcher or MATCHER
+        self.db = Database(self.db_path)
+        self.response_cache = ResponseCache()
         self.error_checker = PythonErrorChecker()
         self.init_database()
+        self.code_cache = CodeCheckCache(self.db if CODE_CACHE_PERSIST else None)
         self.load_training_data()
+        self.responses = ResponseStore(self.db)
+        self.index_lock = threading.RLock()
+        self.next_refresh = 0.0
+        self.rebuild_index()
+        self.stats_counters = StatsCounters(self.db)
+        self.conversation_log = ConversationLogger(
+            self.db,
+            maintenance=self.apply_retention if RETENTION_DAYS > 0 else None,
+            on_write=self.stats_counters.add_conversations
+        )
 
     def init_database(self):
         """Initialize SQLite database for storing conversations"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.db.transaction() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    input_text TEXT NOT NULL,
+                    response_text TEXT NOT NULL,
+                    confidence REAL DEFAULT 0.8,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS patterns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    pattern TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    category TEXT DEFAULT 'general',
+                    builtin INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS code_checks (
+                    digest TEXT PRIMARY KEY,
+                    result TEXT NOT NULL
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+
+            # Databases created before seeding was versioned lack the builtin flag
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(patterns)")]
+            if 'builtin' not in columns:
+                cursor.execute("ALTER TABLE patterns ADD COLUMN builtin INTEGER NOT NULL DEFAULT 0")
+
+        self.migrate()
+
+    # Schema migrations, applied in order; PRAGMA user_version records how many have run
+    MIGRATIONS = (
+        # 1: lookup indexes, one row per (pattern, category), conversation archive, stats rollups
+        (
+            "CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations (timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_patterns_category ON patterns (category)",
+            # Keep the earliest row of each key, which is the one that wins ties,
+            # but with the latest response: re-posting a key now overwrites it
+            '''UPDATE patterns SET response = (
+                SELECT latest.response FROM patterns AS latest
+                WHERE latest.pattern = patterns.pattern AND latest.category IS patterns.category
+                ORDER BY latest.id DESC LIMIT 1
+            ) WHERE id IN (SELECT MIN(id) FROM patterns GROUP BY pattern, category HAVING COUNT(*) > 1)''',
+            "DELETE FROM patterns WHERE id NOT IN (SELECT MIN(id) FROM patterns GROUP BY pattern, category)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_patterns_key ON patterns (pattern, category)",
+            '''CREATE TABLE IF NOT EXISTS conversations_archive (
+                id INTEGER PRIMARY KEY,
                 input_text TEXT NOT NULL,
                 response_text TEXT NOT NULL,
-                confidence REAL DEFAULT 0.8,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS patterns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                pattern TEXT NOT NULL,
-                response TEXT NOT NULL,
-                category TEXT DEFAULT 'general'
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
+                confidence REAL,
+                timestamp DATETIME
+            )''',
+            "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+            "CREATE TABLE IF NOT EXISTS category_counts (category TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)",
+            "INSERT OR REPLACE INTO counters (name, value) SELECT 'conversations', COUNT(*) FROM conversations",
+            "INSERT OR REPLACE INTO counters (name, value) SELECT 'patterns', COUNT(*) FROM patterns",
+            "INSERT OR REPLACE INTO category_counts (category, count) SELECT category, COUNT(*) FROM patterns GROUP BY category",
+            '''CREATE TRIGGER IF NOT EXISTS conversations_count_insert AFTER INSERT ON conversations BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'conversations';
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS conversations_count_delete AFTER DELETE ON conversations BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'conversations';
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS patterns_count_insert AFTER INSERT ON patterns BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'patterns';
+                INSERT INTO category_counts (category, count) VALUES (NEW.category, 1)
+                    ON CONFLICT (category) DO UPDATE SET count = count + 1;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS patterns_count_delete AFTER DELETE ON patterns BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'patterns';
+                UPDATE category_counts SET count = count - 1 WHERE category = OLD.category;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS patterns_count_recategorize AFTER UPDATE OF category ON patterns
+            WHEN OLD.category IS NOT NEW.category BEGIN
+                UPDATE category_counts SET count = count - 1 WHERE category = OLD.category;
+                INSERT INTO category_counts (category, count) VALUES (NEW.category, 1)
+                    ON CONFLICT (category) DO UPDATE SET count = count + 1;
+            END''',
+        ),
+        # 2: count response edits, so a response snapshot can tell it is stale
+        (
+            "INSERT OR IGNORE INTO counters (name, value) VALUES ('pattern_edits', 0)",
+            '''CREATE TRIGGER IF NOT EXISTS patterns_count_edit AFTER UPDATE OF response ON patterns BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'pattern_edits';
+            END''',
+        ),
+    )
+
+    # Insert a pattern, or update the response of the existing (pattern, category) row
+    UPSERT_PATTERN = '''
+        INSERT INTO patterns (pattern, response, category) VALUES (?, ?, ?)
+        ON CONFLICT (pattern, category) DO UPDATE SET response = excluded.response
+        WHERE response != excluded.response
+    '''
+
+    def migrate(self):
+        """Bring the schema up to date, one transaction per migration"""
+        with self.db.connection() as conn:
+            for version, statements in enumerate(self.MIGRATIONS, 1):
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+                with conn:
+                    # Take the write lock first so concurrent workers migrate only once
+                    conn.execute("BEGIN IMMEDIATE")
+                    if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                        continue
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                print(f"🗄️ Migrated {self.db_path} to schema version {version}")
+
+    def apply_retention(self, days=RETENTION_DAYS, mode=RETENTION_MODE, chunk_size=RETENTION_CHUNK):
+        """Archive or delete conversations older than days, chunk_size rows per
+        transaction so writers are never blocked for long; returns rows removed"""
+        if days <= 0:
+            return 0
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        expired = "SELECT id FROM conversations WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?"
+        removed = 0
+
+        with self.db.connection() as conn:
+            while True:
+                with metrics.timer('pybot_db_seconds', operation='retention'), conn:
+                    if mode == 'archive':
+                        conn.execute(
+                            "INSERT OR REPLACE INTO conversations_archive "
+                            "SELECT id, input_text, response_text, confidence, timestamp FROM conversations "
+                            f"WHERE id IN ({expired})",
+                            (cutoff, chunk_size)
+                        )
+                    deleted = conn.execute(f"DELETE FROM conversations WHERE id IN ({expired})", (cutoff, chunk_size)).rowcount
+                removed += deleted
+                if deleted < chunk_size:
+                    break
+
+        if removed:
+            self.stats_counters.reconcile()
+        return removed
+
+    # Bump to force a reseed even if the corpus text is unchanged
+    CORPUS_VERSION = 1
 
     def load_training_data(self):
-        """Load initial training data"""
+        """Seed the built-in training corpus, skipping the work if it is unchanged"""
         training_data = [
             # Greetings
             ("hello", "Hi there! I'm PyBot, your Python programming assistant. How can I help you today?", "greeting"),
@@ -528,142 +2514,390 @@ class SmartChatBot:
             ("property", "Use @property decorator: @property def name(self): return self._name. @name.setter def name(self, value): self._name = value. Provides controlled access.", "oop"),
         ]
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        digest = hashlib.sha256(
+            json.dumps([self.CORPUS_VERSION, training_data]).encode('utf-8')
+        ).hexdigest()
 
-        # Clear existing patterns and add new ones
-        cursor.execute("DELETE FROM patterns")
+        with self.db.transaction() as conn:
+            cursor = conn.cursor()
 
-        for pattern, response, category in training_data:
+            cursor.execute("SELECT value FROM meta WHERE key = 'corpus_hash'")
+            stored = cursor.fetchone()
+            if stored and stored[0] == digest:
+                return
+
+            if stored is None:
+                # Unversioned database: the corpus rows were inserted without the
+                # builtin flag, so claim rows that match the corpus exactly
+                cursor.executemany(
+                    "UPDATE patterns SET builtin = 1 WHERE pattern = ? AND response = ? AND category = ?",
+                    training_data
+                )
+
+            # Upsert only the built-in rows; patterns added through /api/train are left alone
+            existing = {}
+            stale = []
+            cursor.execute("SELECT id, pattern, response, category FROM patterns WHERE builtin = 1 ORDER BY id")
+            for row_id, pattern, response, category in cursor.fetchall():
+                if (pattern, category) in existing:
+                    stale.append((row_id,))
+                else:
+                    existing[(pattern, category)] = (row_id, response)
+
+            corpus = {(pattern, category): response for pattern, response, category in training_data}
+            inserts = [row for row in training_data if (row[0], row[2]) not in existing]
+            updates = [
+                (response, existing[key][0]) for key, response in corpus.items()
+                if key in existing and existing[key][1] != response
+            ]
+            stale += [(row_id,) for key, (row_id, _) in existing.items() if key not in corpus]
+
+            cursor.executemany(
+                "INSERT INTO patterns (pattern, response, category, builtin) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (pattern, category) DO UPDATE SET response = excluded.response, builtin = 1",
+                inserts
+            )
+            cursor.executemany("UPDATE patterns SET response = ? WHERE id = ?", updates)
+            cursor.executemany("DELETE FROM patterns WHERE id = ?", stale)
             cursor.execute(
-                "INSERT INTO patterns (pattern, response, category) VALUES (?, ?, ?)",
-                (pattern, response, category)
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('corpus_hash', ?)",
+                (digest,)
             )
 
-        conn.commit()
-        conn.close()
+    def warm_up(self):
+        """Start the sandbox workers so the first code check does not pay for it"""
+        self.error_checker.executor.start()
+
+    def shutdown(self):
+        """Drain queued conversation logs and release workers and connections"""
+        self.conversation_log.close()
+        self.error_checker.executor.close()
+        if isinstance(self.matcher, ShardedMatcher):
+            self.matcher.close()
+        self.db.close()
+
+    def rebuild_index(self):
+        """Build the in-memory pattern index from the patterns table
+
+        Only pattern keys, ids and categories are loaded; response bodies are
+        read from self.responses for the pattern that wins.
+        """
+        with self.index_lock:
+            with self.db.connection() as conn:
+                # One read transaction, so the fingerprint matches the rows
+                conn.execute("BEGIN")
+                fingerprint = ResponseStore.fingerprint(conn)
+                rows = conn.execute("SELECT pattern, id, category FROM patterns ORDER BY id").fetchall()
+            self.pattern_index = PatternIndex(rows)
+            self.indexed = (fingerprint, len(rows))
+            self.responses.sync()
+            previous, self.matcher = getattr(self, 'matcher', None), self.build_matcher()
+            if isinstance(previous, ShardedMatcher):
+                previous.close()
+
+    def refresh_patterns(self):
+        """Pick up patterns trained through other worker processes
+
+        Every worker keeps its own index, so at most once per
+        PATTERN_REFRESH_INTERVAL seconds the patterns table fingerprint is
+        compared with the one the index was built from. Rows inserted since
+        are appended; edits or deletions rebuild the index. Either way cached
+        replies are dropped. A response snapshot rewritten by another worker
+        is picked up too.
+        """
+        now = time.monotonic()
+        if now < self.next_refresh:
+            return
+        with self.index_lock:
+            if now < self.next_refresh:
+                return
+            self.next_refresh = now + PATTERN_REFRESH_INTERVAL
+            (patterns, edits, max_id), indexed = self.indexed
+            with self.db.connection() as conn:
+                conn.execute("BEGIN")
+                fingerprint = ResponseStore.fingerprint(conn)
+                changed = fingerprint != (patterns, edits, max_id)
+                rows = []
+                if changed and fingerprint[1] == edits:
+                    rows = conn.execute(
+                        "SELECT pattern, id, category FROM patterns WHERE id > ? ORDER BY id", (max_id,)
+                    ).fetchall()
+
+            if changed:
+                # Skip rows this worker trained itself since the last check
+                local = set(self.pattern_index.response_ids[indexed:])
+                rows = [row for row in rows if row[1] not in local]
+                if fingerprint[1] == edits and len(self.pattern_index) + len(rows) == fingerprint[0]:
+                    self.append_patterns(rows)
+                    self.indexed = (fingerprint, len(self.pattern_index))
+                else:
+                    # Also drops cached bodies and brings the snapshot up to date
+                    self.rebuild_index()
+                self.response_cache.clear()
+            self.responses.refresh(fingerprint)
+
+    def append_patterns(self, rows):
+        """Add new (pattern, id, category) rows to the live index and matcher"""
+        for pattern, row_id, category in rows:
+            self.pattern_index.add(pattern, row_id, category)
+        if rows and isinstance(self.matcher, TfidfMatcher):
+            self.matcher = self.build_matcher()
+
+    def build_matcher(self):
+        """Create the configured matcher backend over the current pattern index"""
+        if self.matcher_name == 'tfidf':
+            if np is not None:
+                return TfidfMatcher(self.pattern_index)
+            print("⚠️ NumPy is not installed - falling back to the index matcher")
+        elif SHARD_WORKERS > 1 and len(self.pattern_index) >= SHARD_THRESHOLD:
+            return ShardedMatcher(self.pattern_index)
+        return self.pattern_index
+
+    def add_pattern(self, pattern, response, category):
+        """Store a new training pattern and make it matchable immediately"""
+        # Holding the index lock keeps appended ids in order for refresh_patterns
+        with self.index_lock:
+            with metrics.timer('pybot_db_seconds', operation='train'), self.db.transaction() as conn:
+                # Take the write lock before looking, so a concurrent train of the
+                # same key (from another worker) cannot slip in between the check
+                # and the upsert and leave lastrowid stale
+                conn.execute("BEGIN IMMEDIATE")
+                existed = conn.execute(
+                    "SELECT 1 FROM patterns WHERE pattern = ? AND category = ?", (pattern, category)
+                ).fetchone() is not None
+                row_id = conn.execute(self.UPSERT_PATTERN, (pattern, response, category)).lastrowid
+
+            if existed:
+                # The response changed in place, so the row keeps its position
+                self.rebuild_index()
+            else:
+                self.append_patterns([(pattern, row_id, category)])
+                self.stats_counters.add_pattern(category)
+        self.response_cache.clear()
+
+    def import_patterns(self, rows, batch_size=IMPORT_BATCH_SIZE):
+        """Upsert (pattern, response, category) rows keyed on (pattern, category)
+
+        Existing keys get their response updated, new keys are inserted, and
+        later duplicates in the input win. Rows are written in transactions of
+        batch_size, and the index, matcher and reply cache are rebuilt once at
+        the end. Returns counts of inserted, updated and unchanged rows.
+        """
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        rows = iter(rows)
+        pattern_count = "SELECT value FROM counters WHERE name = 'patterns'"
+
+        try:
+            with self.db.connection() as conn:
+                while True:
+                    chunk = list(islice(rows, batch_size))
+                    if not chunk:
+                        break
+                    with metrics.timer('pybot_db_seconds', operation='import'), conn:
+                        before = conn.execute(pattern_count).fetchone()[0]
+                        # rowcount counts inserts and real updates, not no-op conflicts
+                        changed = conn.executemany(self.UPSERT_PATTERN, chunk).rowcount
+                        inserted = conn.execute(pattern_count).fetchone()[0] - before
+                    counts['inserted'] += inserted
+                    counts['updated'] += changed - inserted
+                    counts['unchanged'] += len(chunk) - changed
+        finally:
+            # Committed chunks stay even if a later one failed, so always resync
+            if counts['inserted'] or counts['updated']:
+                self.rebuild_index()
+                self.response_cache.clear()
+                self.stats_counters.reconcile()
+
+        return counts
+
+    def log_conversation(self, input_text, response_text, confidence):
+        """Queue one conversation turn for the background writer"""
+        self.conversation_log.log(input_text, response_text, confidence)
 
     def similarity(self, a, b):
         """Calculate similarity between two strings"""
         return SequenceMatcher(None, a.lower(), b.lower()).ratio()
 
-    def get_response(self, user_input, style='balanced', original_message=None):
-        """Get response for user input with style customization and code checking"""
+    def get_response(self, user_input, style='balanced', original_message=None, top_k=0):
+        """Get response for user input with style customization and code checking
+
+        With top_k, the response also lists the top_k pattern matches as
+        'matches', found in the same pass as the reply.
+        """
+        response = self.answer(user_input, style, top_k)
+
+        # Store conversation
+        with metrics.stage('log'):
+            self.log_conversation(original_message or user_input, response['message'], response['confidence'])
+
+        return response
+
+    def get_responses(self, messages, style='balanced'):
+        """Answer a list of messages in one call
+
+        Distinct messages are answered one after another, each with its own
+        pattern search (or code check); what the batch shares is that repeated
+        messages are answered once, and that all conversations are logged in
+        a single transaction. Results are returned in input order.
+        """
+        answers = {}
+        responses = []
+        for message in messages:
+            response = answers.get(message)
+            if response is None:
+                response = answers[message] = self.answer(message, style)
+            responses.append(response)
+
+        with metrics.stage('log'):
+            self.conversation_log.log_many(
+                (message, response['message'], response['confidence'])
+                for message, response in zip(messages, responses)
+            )
+
+        return responses
+
+    def stream_response(self, user_input, style='balanced', original_message=None):
+        """Like get_response, but yields the reply as (section, text) fragments
+
+        Concatenated, the fragments give the same message as get_response; no
+        fragment is longer than STREAM_CHUNK_SIZE. The last item is
+        ('done', {confidence, category, style}). Closing the generator early
+        cancels the remaining checks and nothing is logged.
+        """
+        with metrics.stage('extract_code'):
+            code = self.extract_code_from_message(user_input)
+
+        if code:
+            parts = []
+            sections = self.code_check_sections(code, style)
+            try:
+                for section, part in sections:
+                    text = '\n' + part if parts else part
+                    parts.append(part)
+                    for start in range(0, len(text), STREAM_CHUNK_SIZE):
+                        yield section, text[start:start + STREAM_CHUNK_SIZE]
+            finally:
+                sections.close()
+            metrics.inc('pybot_replies_total', source='code_check')
+            response = {'message': '\n'.join(parts), 'confidence': 1.0, 'category': 'code_check', 'style': style}
+        else:
+            response = self.answer_pattern(user_input, style)
+            message = response['message']
+            for start in range(0, len(message), STREAM_CHUNK_SIZE):
+                yield 'reply', message[start:start + STREAM_CHUNK_SIZE]
+
+        with metrics.stage('log'):
+            self.log_conversation(original_message or user_input, response['message'], response['confidence'])
+
+        yield 'done', {key: value for key, value in response.items() if key != 'message'}
+
+    def answer(self, user_input, style='balanced', top_k=0):
+        """Build the reply for user input without logging it"""
         # First check if the message contains code
         code_response = self.check_code_and_respond(user_input, style)
         if code_response:
-            # Store code checking conversation
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO conversations (input_text, response_text, confidence) VALUES (?, ?, ?)",
-                (original_message or user_input, code_response, 1.0)
-            )
-            conn.commit()
-            conn.close()
+            metrics.inc('pybot_replies_total', source='code_check')
 
-            return {
+            response = {
                 'message': code_response,
                 'confidence': 1.0,
                 'category': 'code_check',
                 'style': style
             }
+            if top_k:
+                response['matches'] = []
+            return response
 
-        # Clean the input for pattern matching
-        clean_input = user_input.lower().strip()
-
-        # Remove style prefixes for better pattern matching
-        style_prefixes = [
-            'please provide a detailed, comprehensive explanation:',
-            'please provide a brief, concise answer:',
-            'please explain in beginner-friendly terms with simple examples:',
-            'please provide a detailed explanation:',
-            'please explain simply:'
-        ]
+        return self.answer_pattern(user_input, style, top_k)
 
-        for prefix in style_prefixes:
-            if clean_input.startswith(prefix):
-                clean_input = clean_input[len(prefix):].strip()
-                break
+    def answer_pattern(self, user_input, style='balanced', top_k=0):
+        """Reply to a message that contains no code from the pattern set"""
+        self.refresh_patterns()
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Get all patterns
-        cursor.execute("SELECT pattern, response, category FROM patterns")
-        patterns = cursor.fetchall()
-
-        best_match = None
-        best_score = 0
-
-        # Find best matching pattern
-        for pattern, response, category in patterns:
-            score = 0
-
-            # Check for exact matches first (highest priority)
-            if clean_input == pattern:
-                score = 1.0
-            # Check if pattern is contained in user input
-            elif pattern in clean_input:
-                # Give higher score for longer, more specific patterns
-                score = 0.8 + (len(pattern) / max(len(clean_input), 10)) * 0.2
-
-                # Bonus for exact word matches
-                user_words = clean_input.split()
-                pattern_words = pattern.split()
-                word_matches = sum(1 for word in pattern_words if word in user_words)
-                if word_matches == len(pattern_words):
-                    score += 0.1
-
-            # Check if user input is contained in pattern
-            elif clean_input in pattern:
-                score = 0.7
-            else:
-                # Use similarity matching as fallback
-                score = self.similarity(pattern, clean_input)
-                # Lower the threshold for similarity matching
-                if score < 0.6:
-                    score = 0
+        # Clean the input for pattern matching
+        clean_input = self.clean_input(user_input)
+
+        # Unknown styles render like 'balanced', so they can share cache entries
+        cache_key = (clean_input, style if style in self.STYLES else 'balanced')
+        generation = self.response_cache.generation
+        matches = None
+        if top_k:
+            # The candidates come from the same pass as the reply, so the
+            # cache can be refreshed but not used
+            matches = self.find_matches(clean_input, top_k)
+            reply = None
+        else:
+            reply = self.response_cache.get(cache_key)
+        if reply is None:
+            reply = self.match_response(clean_input, style, matches)
+            self.response_cache.put(cache_key, reply, generation)
+            metrics.inc('pybot_replies_total', source='default' if reply[2] == 'default' else 'pattern')
+        else:
+            metrics.inc('pybot_replies_total', source='cache')
 
-            if score > best_score and score > 0.3:  # Minimum threshold
-                best_score = score
-                best_match = (pattern, response, category)
+        message, confidence, category = reply
 
-        if best_match:
-            base_response = best_match[1]
-            styled_response = self.apply_response_style(base_response, style, best_match[2])
+        response = {
+            'message': message,
+            'confidence': confidence,
+            'category': category,
+            'style': style
+        }
+        if top_k:
+            response['matches'] = [
+                {'pattern': pattern, 'category': category, 'score': score, 'probability': calibrate_score(score)}
+                for score, pattern, _, category in matches
+            ]
+        return response
 
-            # Store conversation
-            cursor.execute(
-                "INSERT INTO conversations (input_text, response_text, confidence) VALUES (?, ?, ?)",
-                (original_message or user_input, styled_response, best_score)
-            )
-            conn.commit()
-            conn.close()
+    def clean_input(self, user_input):
+        """Lowercase the input and remove a leading style instruction"""
+        clean_input = user_input.lower().strip()
+        prefix = self.STYLE_PREFIX.match(clean_input)
+        if prefix:
+            clean_input = clean_input[prefix.end():].strip()
+        return clean_input
+
+    def find_matches(self, clean_input, k):
+        """Top k (score, pattern, response_id, category) matches for cleaned input, best first"""
+        # Search via the configured matcher backend
+        with metrics.stage('match'):
+            matches = self.matcher.top_matches(clean_input, k)
+            if not matches:
+                # Nothing matched as typed: retry once with punctuation, plurals
+                # and single-character typos normalized against the patterns
+                normalized = self.pattern_index.normalize(clean_input)
+                if normalized and normalized != clean_input:
+                    matches = self.matcher.top_matches(normalized, k)
+        return matches
+
+    def match_response(self, clean_input, style, matches=None):
+        """Find and style the best reply for cleaned input; returns (message, confidence, category)
+
+        matches, if given, are the find_matches results to reply from.
+        """
+        if matches is None:
+            matches = self.find_matches(clean_input, 1)
+
+        with metrics.stage('style'):
+            if matches:
+                best_score, _, response_id, category = matches[0]
+                styled = self.styled_response(response_id, style, category)
+                if styled is not None:
+                    return styled, best_score, category
 
-            return {
-                'message': styled_response,
-                'confidence': best_score,
-                'category': best_match[2],
-                'style': style
-            }
-        else:
             # Default response with style
-            default_response = self.get_default_response(style)
-
-            cursor.execute(
-                "INSERT INTO conversations (input_text, response_text, confidence) VALUES (?, ?, ?)",
-                (original_message or user_input, default_response, 0.1)
-            )
-            conn.commit()
-            conn.close()
-
-            return {
-                'message': default_response,
-                'confidence': 0.1,
-                'category': 'default',
-                'style': style
-            }
+            return self.get_default_response(style), 0.1, 'default'
+
+    def styled_response(self, response_id, style, category):
+        """Styled reply for a pattern row, rendered once per (row, style) and
+        then served from the response store; None if the row is gone"""
+        if style not in ('detailed', 'concise', 'beginner'):
+            # balanced, and unknown styles, use the body as is
+            return self.responses.get(response_id)
+        return self.responses.rendered(
+            response_id, style, lambda body: self.apply_response_style(body, style, category)
+        )
 
     def apply_response_style(self, base_response, style, category):
         """Apply different response styles to the base response"""
@@ -678,15 +2912,7 @@ class SmartChatBot:
 
     def make_detailed_response(self, response, category):
         """Create a detailed version of the response"""
-        detailed_additions = {
-            'functions': "\n\n**Additional Details:**\n• Functions can have default parameters: def greet(name='World'): return f'Hello {name}'\n• Use *args for variable arguments: def sum_all(*args): return sum(args)\n• Use **kwargs for keyword arguments: def info(**kwargs): print(kwargs)\n• Functions are first-class objects and can be passed as arguments",
-            'lists': "\n\n**Advanced List Operations:**\n• List slicing: my_list[1:3] gets elements from index 1 to 2\n• List comprehensions: [x*2 for x in range(5) if x % 2 == 0]\n• Nested lists: matrix = [[1,2], [3,4]]\n• List methods: .count(), .index(), .copy(), .clear()",
-            'strings': "\n\n**String Advanced Features:**\n• String slicing: text[1:5] gets substring from index 1 to 4\n• Raw strings: r'C:\\path\\to\\file' (no escape sequences)\n• Multi-line strings: '''Line 1\nLine 2\nLine 3'''\n• String formatting: f'{name:>10}' (right-align in 10 chars)",
-            'loops': "\n\n**Loop Advanced Concepts:**\n• Loop with else: for/while loops can have else clause (runs if no break)\n• Nested loops: for i in range(3): for j in range(3): print(i, j)\n• Loop control: break (exit), continue (skip), pass (do nothing)\n• Enumerate: for i, value in enumerate(list) gives index and value",
-        }
-
-        addition = detailed_additions.get(category, "\n\n**Pro Tip:** This is a fundamental Python concept. Practice with different examples to master it!")
-        return response + addition
+        return response + self.DETAILED_ADDITIONS.get(category, self.DETAILED_DEFAULT)
 
     def make_concise_response(self, response):
         """Create a concise version of the response"""
@@ -696,7 +2922,7 @@ class SmartChatBot:
             # Keep first sentence and any code examples
             core = sentences[0] + '.'
             # Add code examples if they exist
-            if ':' in response and any(keyword in response for keyword in ['import', 'def', '=', 'print']):
+            if ':' in response and any(keyword in response for keyword in self.CONCISE_CODE_HINTS):
                 code_part = response[response.find(':'):].split('.')[0] + '.'
                 return core + ' ' + code_part
             return core
@@ -704,125 +2930,135 @@ class SmartChatBot:
 
     def make_beginner_response(self, response, category):
         """Create a beginner-friendly version of the response"""
-        beginner_intros = {
-            'functions': "🔧 **Functions** are like recipes in cooking - they take ingredients (parameters) and create something (return value). ",
-            'lists': "📝 **Lists** are like shopping lists - you can add items, remove items, and check what's in them. ",
-            'strings': "📄 **Strings** are just text - like words in a book. You can join them, split them, and change them. ",
-            'loops': "🔄 **Loops** are like doing the same task multiple times - like washing dishes one by one. ",
-            'variables': "📦 **Variables** are like labeled boxes where you store things for later use. ",
-            'dictionaries': "📚 **Dictionaries** are like phone books - you look up a name (key) to find a number (value). ",
-        }
-
-        intro = beginner_intros.get(category, "🐍 **Python Concept:** ")
-
-        # Add beginner-friendly explanation
-        beginner_suffix = "\n\n💡 **Remember:** Start simple and practice! Every expert was once a beginner. Try typing this code in Python to see how it works."
-
-        return intro + response + beginner_suffix
+        intro = self.BEGINNER_INTROS.get(category, self.BEGINNER_DEFAULT)
+        return intro + response + self.BEGINNER_SUFFIX
 
     def detect_code_in_message(self, message):
         """Detect if message contains Python code"""
-        code_indicators = [
-            'def ', 'class ', 'import ', 'from ', 'print(', 'if ', 'for ', 'while ',
-            'try:', 'except:', '=', '==', '!=', '+=', '-=', 'return ', 'yield ',
-            '[', ']', '{', '}', '()', 'lambda ', 'with ', 'as ', 'in ', 'not ',
-            'and ', 'or ', 'True', 'False', 'None'
-        ]
-
         # Check for code blocks (triple backticks)
         if '```' in message:
             return True
 
-        # Check for multiple code indicators
-        indicator_count = sum(1 for indicator in code_indicators if indicator in message)
-
         # If message has multiple code indicators, likely contains code
-        return indicator_count >= 3
+        found = 0
+        for indicator in self.CODE_INDICATORS:
+            if indicator in message:
+                found += 1
+                if found >= 3:
+                    return True
+        return False
 
     def extract_code_from_message(self, message):
         """Extract Python code from message"""
-        # Look for code blocks first
-        code_block_pattern = r'```(?:python)?\s*(.*?)\s*```'
-        code_blocks = re.findall(code_block_pattern, message, re.DOTALL)
+        # Plain-English questions skip the code path entirely
+        if not self.CODE_PUNCTUATION.search(message):
+            return None
 
-        if code_blocks:
-            return '\n'.join(code_blocks)
+        # Look for code blocks first
+        if '```' in message:
+            code_blocks = self.CODE_FENCE.findall(message)
+            if code_blocks:
+                return '\n'.join(code_blocks)
 
         # If no code blocks, try to extract code-like content
-        lines = message.split('\n')
         code_lines = []
-
-        for line in lines:
-            line_stripped = line.strip()
+        for line in message.split('\n'):
+            line = line.strip()
             # Look for lines that look like Python code
-            if (line_stripped.startswith(('def ', 'class ', 'import ', 'from ', 'if ', 'for ', 'while ', 'try:', 'print(')) or
-                '=' in line_stripped or 'return ' in line_stripped):
-                code_lines.append(line_stripped)
+            if line.startswith(self.CODE_PREFIXES) or '=' in line or 'return ' in line:
+                code_lines.append(line)
 
         return '\n'.join(code_lines) if code_lines else None
 
     def check_code_and_respond(self, message, style):
         """Check if message contains code and provide error checking"""
-        code = self.extract_code_from_message(message)
+        with metrics.stage('extract_code'):
+            code = self.extract_code_from_message(message)
 
         if not code:
             return None
 
-        # Perform syntax check
-        syntax_result = self.error_checker.check_syntax(code)
-
-        # Perform code analysis
-        analysis_result = self.error_checker.analyze_code(code)
+        return '\n'.join(part for _, part in self.code_check_sections(code, style))
 
-        # Try to execute code safely
-        execution_result = self.error_checker.safe_execute(code)
+    def code_check_sections(self, code, style):
+        """Yield the code-check report as (section, text) parts, in order
 
-        # Build response based on results
-        response_parts = []
+        Each stage runs only when its section is needed, so a streaming caller
+        gets the syntax verdict before the code has been executed and can stop
+        the remaining work by closing the generator.
+        """
+        if style == 'beginner':
+            yield 'header', "🔍 **Code Analysis Results:**"
+
+        # Identical snippets reuse earlier results instead of re-running them
+        digest = self.code_cache.key(code)
+        cached = self.code_cache.get(digest)
+        if cached is not None:
+            syntax_result, analysis_result, execution_result = cached
+            metrics.inc('pybot_code_checks_total', source='cache')
+        else:
+            # Perform syntax check (parsing once and reusing the AST for analysis)
+            with metrics.stage('syntax_check'):
+                syntax_result, tree = self.error_checker.parse(code)
+            analysis_result = execution_result = None
 
         if syntax_result['valid']:
-            response_parts.append("✅ **Code Syntax Check: PASSED**")
+            yield 'syntax', "✅ **Code Syntax Check: PASSED**"
+
+            # Try to execute code safely
+            if execution_result is None:
+                with metrics.stage('execute'):
+                    execution_result = self.error_checker.safe_execute(code)
 
             if execution_result['success']:
-                response_parts.append("✅ **Code Execution: SUCCESS**")
+                yield 'execution', "✅ **Code Execution: SUCCESS**"
                 if execution_result['output']:
-                    response_parts.append(f"**Output:**\n```\n{execution_result['output']}\n```")
+                    yield 'output', f"**Output:**\n```\n{execution_result['output']}\n```"
             else:
-                response_parts.append("❌ **Code Execution: FAILED**")
-                response_parts.append(f"**Error:** {execution_result['error']}")
-                response_parts.append(f"**Suggestion:** {execution_result['suggestion']}")
+                yield 'execution', "❌ **Code Execution: FAILED**"
+                yield 'execution', f"**Error:** {execution_result['error']}"
+                yield 'execution', f"**Suggestion:** {execution_result['suggestion']}"
+            if execution_result.get('truncated'):
+                yield 'output', f"**Note:** Output truncated - {execution_result['truncated']} more characters not shown"
         else:
-            response_parts.append("❌ **Code Syntax Check: FAILED**")
-            response_parts.append(f"**Error:** {syntax_result['message']}")
+            yield 'syntax', "❌ **Code Syntax Check: FAILED**"
+            yield 'syntax', f"**Error:** {syntax_result['message']}"
             if 'line' in syntax_result:
-                response_parts.append(f"**Line:** {syntax_result['line']}")
-            response_parts.append(f"**Suggestion:** {syntax_result['suggestion']}")
+                yield 'syntax', f"**Line:** {syntax_result['line']}"
+            yield 'syntax', f"**Suggestion:** {syntax_result['suggestion']}"
+
+        # Perform code analysis
+        if analysis_result is None:
+            with metrics.stage('analyze_code'):
+                analysis_result = self.error_checker.analyze_code(code, tree)
+
+        if cached is None:
+            if self.error_checker.is_deterministic(tree, execution_result):
+                self.code_cache.put(digest, (syntax_result, analysis_result, execution_result))
+            metrics.inc('pybot_code_checks_total', source='execute')
 
         # Add code analysis
         if analysis_result['issues']:
-            response_parts.append("⚠️ **Issues Found:**")
+            yield 'issues', "⚠️ **Issues Found:**"
             for issue in analysis_result['issues']:
-                response_parts.append(f"• {issue}")
+                yield 'issues', f"• {issue}"
 
         if analysis_result['suggestions']:
-            response_parts.append("💡 **Suggestions:**")
+            yield 'suggestions', "💡 **Suggestions:**"
             for suggestion in analysis_result['suggestions']:
-                response_parts.append(f"• {suggestion}")
+                yield 'suggestions', f"• {suggestion}"
 
-        response_parts.append(f"**Code Complexity:** {analysis_result['complexity']}")
+        yield 'complexity', f"**Code Complexity:** {analysis_result['complexity']}"
 
         # Style-specific additions
         if style == 'beginner':
-            response_parts.insert(0, "🔍 **Code Analysis Results:**")
-            response_parts.append("\n💡 **Learning Tip:** Code checking helps you write better Python! Keep practicing and learning from errors.")
+            yield 'tips', "\n💡 **Learning Tip:** Code checking helps you write better Python! Keep practicing and learning from errors."
         elif style == 'detailed':
-            response_parts.append("\n**Code Quality Tips:**")
-            response_parts.append("• Follow PEP 8 style guidelines")
-            response_parts.append("• Use meaningful variable names")
-            response_parts.append("• Add comments for complex logic")
-            response_parts.append("• Handle exceptions appropriately")
-
-        return '\n'.join(response_parts)
+            yield 'tips', "\n**Code Quality Tips:**"
+            yield 'tips', "• Follow PEP 8 style guidelines"
+            yield 'tips', "• Use meaningful variable names"
+            yield 'tips', "• Add comments for complex logic"
+            yield 'tips', "• Handle exceptions appropriately"
 
     def get_default_response(self, style):
         """Get default response based on style"""
@@ -835,9 +3071,53 @@ class SmartChatBot:
         else:  # balanced
             return "I'm here to help with Python programming! Try asking about strings, print(), lists, functions, loops, variables, frameworks, or send me Python code to check for errors."
 
-# Initialize chatbot
-chatbot = SmartChatBot()
-print("✅ PyBot Smart Chatbot initialized successfully!")
+# The chatbot is created lazily, once per process: importing this module (for
+# example in a pre-forking server's master) opens no SQLite handles and starts
+# no threads or sandbox workers that a forked worker could inherit.
+_chatbot = None
+_chatbot_pid = None
+_chatbot_lock = threading.Lock()
+
+def get_chatbot():
+    """Return this process's chatbot, initializing it on first use"""
+    global _chatbot, _chatbot_pid
+    if _chatbot is None or _chatbot_pid != os.getpid():
+        with _chatbot_lock:
+            if _chatbot is None or _chatbot_pid != os.getpid():
+                _chatbot = SmartChatBot()
+                _chatbot_pid = os.getpid()
+                print("✅ PyBot Smart Chatbot initialized successfully!")
+    return _chatbot
+
+def __getattr__(name):
+    # Keep `chatbot_backend.chatbot` working for scripts that import it
+    if name == 'chatbot':
+        return get_chatbot()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def shutdown_chatbot():
+    """Gracefully stop this process's chatbot, if it was started"""
+    if _chatbot is not None and _chatbot_pid == os.getpid():
+        _chatbot.shutdown()
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    with metrics.lock:
+        metrics.in_flight += 1
+
+@app.after_request
+def record_request_metrics(response):
+    metrics.inc('pybot_requests_total', endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    with metrics.lock:
+        metrics.in_flight -= 1
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.observe('pybot_request_seconds', time.perf_counter() - started, endpoint=request.endpoint or 'unknown')
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -847,19 +3127,25 @@ def chat():
         message = data.get('message', '').strip()
         style = data.get('style', 'balanced')
         original_message = data.get('original_message', message)
+        top_k = data.get('top_k', 0)
 
         if not message:
             return jsonify({'error': 'No message provided'}), 400
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or not 0 <= top_k <= TOP_K_MAX:
+            return jsonify({'error': f'top_k must be an integer from 0 to {TOP_K_MAX}'}), 400
 
         # Get response from chatbot with style
-        response = chatbot.get_response(message, style=style, original_message=original_message)
+        response = get_chatbot().get_response(message, style=style, original_message=original_message, top_k=top_k)
 
-        return jsonify({
+        body = {
             'message': response['message'],
             'confidence': response['confidence'],
             'category': response.get('category', 'general'),
             'style': response.get('style', style)
-        })
+        }
+        if top_k:
+            body['matches'] = response['matches']
+        return jsonify(body)
 
     except Exception as e:
         print(f"Chat error: {e}")
@@ -870,43 +3156,142 @@ def chat():
             'style': 'balanced'
         }), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream a chat reply section by section as NDJSON, or as SSE when asked for
+
+    Each event is {"type": "section", "section": ..., "text": ...}; the texts
+    concatenate to the /api/chat message. The last event is {"type": "done"}
+    with the confidence, category and style.
+    """
+    data = request.get_json(silent=True) or {}
+    message = data.get('message', '').strip()
+    style = data.get('style', 'balanced')
+    original_message = data.get('original_message', message)
+
+    if not message:
+        return jsonify({'error': 'No message provided'}), 400
+
+    sse = request.args.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    fragments = get_chatbot().stream_response(message, style=style, original_message=original_message)
+
+    def encode(event):
+        line = json.dumps(event)
+        return f"data: {line}\n\n" if sse else line + '\n'
+
+    def generate():
+        # A client disconnect closes this generator (GeneratorExit), which in
+        # turn closes the chatbot's generator before any further work is done
+        outcome = 'cancelled'
+        try:
+            for section, payload in fragments:
+                if section == 'done':
+                    yield encode(dict(payload, type='done'))
+                else:
+                    yield encode({'type': 'section', 'section': section, 'text': payload})
+            outcome = 'completed'
+        except Exception as e:
+            outcome = 'error'
+            print(f"Chat stream error: {e}")
+            yield encode({'type': 'error', 'error': 'Sorry, I encountered an error while streaming the reply.'})
+        finally:
+            fragments.close()
+            metrics.inc('pybot_streams_total', outcome=outcome)
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """Answer a list of messages in one request, e.g. to replay logged questions"""
+    data = request.get_json(silent=True) or {}
+    messages = data.get('messages')
+    style = data.get('style', 'balanced')
+
+    if not isinstance(messages, list) or not messages:
+        return jsonify({'error': 'messages must be a non-empty list'}), 400
+    if len(messages) > BATCH_MAX_MESSAGES:
+        return jsonify({'error': f'At most {BATCH_MAX_MESSAGES} messages per batch'}), 400
+
+    cleaned = []
+    for i, message in enumerate(messages):
+        if not isinstance(message, str) or not message.strip():
+            return jsonify({'error': f'Message {i} is empty or not a string'}), 400
+        cleaned.append(message.strip())
+
+    try:
+        responses = get_chatbot().get_responses(cleaned, style=style)
+    except Exception as e:
+        print(f"Batch chat error: {e}")
+        return jsonify({'error': f'Batch failed: {e}'}), 500
+
+    return jsonify({
+        'count': len(responses),
+        'results': [
+            {
+                'message': response['message'],
+                'confidence': response['confidence'],
+                'category': response.get('category', 'general'),
+                'style': response.get('style', style)
+            }
+            for response in responses
+        ]
+    })
+
 @app.route('/api/status', methods=['GET'])
 def status():
     """Check chatbot status"""
+    chatbot = get_chatbot()
     return jsonify({
         'status': 'online',
         'chatbot_available': True,
         'backend_type': 'Smart Pattern Matching',
-        'database': 'SQLite Local Storage'
+        'database': 'SQLite Local Storage',
+        'conversation_log': chatbot.conversation_log.stats(),
+        'response_cache': chatbot.response_cache.stats(),
+        'code_cache': chatbot.code_cache.stats(),
+        'response_store': chatbot.responses.stats()
     })
 
 @app.route('/api/stats', methods=['GET'])
 def stats():
-    """Get chatbot statistics"""
+    """Get chatbot statistics; supports If-None-Match for cheap polling"""
     try:
-        conn = sqlite3.connect(chatbot.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT COUNT(*) FROM conversations")
-        total_conversations = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM patterns")
-        total_patterns = cursor.fetchone()[0]
-
-        cursor.execute("SELECT category, COUNT(*) FROM patterns GROUP BY category")
-        categories = dict(cursor.fetchall())
-
-        conn.close()
-
-        return jsonify({
-            'total_conversations': total_conversations,
-            'total_patterns': total_patterns,
-            'categories': categories
-        })
-
+        body, etag = get_chatbot().stats_counters.snapshot()
     except Exception as e:
         return jsonify({'error': f'Stats failed: {e}'}), 500
 
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose counters, stage latency histograms and cache/index gauges"""
+    chatbot = get_chatbot()
+    gauges = [
+        ('pybot_in_flight_requests', 'Requests currently being handled', {}, metrics.in_flight),
+        ('pybot_patterns', 'Patterns in the in-memory index', {}, len(chatbot.pattern_index)),
+    ]
+    for name, value in chatbot.response_cache.stats().items():
+        gauges.append(('pybot_response_cache', 'Response cache statistics', {'stat': name}, value))
+    for name, value in chatbot.code_cache.stats().items():
+        gauges.append(('pybot_code_cache', 'Code check cache statistics', {'stat': name}, int(value)))
+    for name, value in chatbot.responses.stats().items():
+        if isinstance(value, int):
+            gauges.append(('pybot_response_store', 'Response body store statistics', {'stat': name}, value))
+    for name, value in chatbot.conversation_log.stats().items():
+        gauges.append(('pybot_conversation_log', 'Conversation log writer statistics', {'stat': name}, value))
+    executor = chatbot.error_checker.executor
+    for name, value in (('timeouts', executor.timeouts), ('crashes', executor.crashes), ('idle_workers', executor.idle.qsize())):
+        gauges.append(('pybot_code_executor', 'Sandbox worker pool statistics', {'stat': name}, value))
+
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/train', methods=['POST'])
 def train():
     """Add new training pattern"""
@@ -919,34 +3304,240 @@ def train():
         if not pattern or not response:
             return jsonify({'error': 'Pattern and response are required'}), 400
 
-        conn = sqlite3.connect(chatbot.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "INSERT INTO patterns (pattern, response, category) VALUES (?, ?, ?)",
-            (pattern, response, category)
-        )
-
-        conn.commit()
-        conn.close()
+        get_chatbot().add_pattern(pattern, response, category)
 
         return jsonify({'message': 'Training pattern added successfully'})
 
     except Exception as e:
         return jsonify({'error': f'Training failed: {e}'}), 500
 
+@app.route('/api/train/bulk', methods=['POST'])
+def train_bulk():
+    """Import many training patterns from a JSON-lines or CSV upload
+
+    Accepts a multipart 'file' field or the raw request body. The format comes
+    from ?format=jsonl|csv, else the file name or Content-Type.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, fmt = upload.stream, training_format(upload.filename, upload.mimetype)
+    else:
+        stream, fmt = request.stream, training_format(mimetype=request.mimetype)
+    fmt = request.args.get('format') or fmt
+    if fmt not in ('jsonl', 'csv'):
+        return jsonify({'error': 'Upload JSON lines or CSV (set ?format=jsonl or ?format=csv)'}), 400
+
+    report = {'skipped': 0, 'errors': []}
+    try:
+        lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        counts = get_chatbot().import_patterns(read_training_rows(lines, fmt, report))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'Import failed: {e}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Import failed: {e}'}), 500
+
+    return jsonify(dict(counts, **report))
+
+def serve_production(host, port, workers=SERVER_WORKERS, threads=SERVER_THREADS):
+    """Serve the app with a multi-process WSGI server
+
+    Uses gunicorn (gthread workers) where available and falls back to waitress,
+    which is single-process but multi-threaded, e.g. on Windows. Each worker
+    builds its own chatbot after the fork and drains its conversation log queue
+    on graceful shutdown.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is not None:
+        class PyBotApplication(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', workers)
+                self.cfg.set('threads', threads)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('graceful_timeout', 30)
+                self.cfg.set('post_fork', lambda server, worker: get_chatbot().warm_up())
+                self.cfg.set('worker_exit', lambda server, worker: shutdown_chatbot())
+
+            def load(self):
+                return app
+
+        PyBotApplication().run()
+        return
+
+    try:
+        from waitress import serve
+    except ImportError:
+        print("❌ Production mode needs gunicorn or waitress: pip install gunicorn (or waitress)")
+        sys.exit(1)
+
+    if workers > 1:
+        print(f"⚠️ waitress runs a single process - ignoring --workers {workers}")
+
+    # Turn SIGTERM into a normal exit so the log queue is drained
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    get_chatbot().warm_up()
+    try:
+        serve(app, host=host, port=port, threads=threads)
+    finally:
+        shutdown_chatbot()
+
+def async_app(wsgi_app, threads=SERVER_THREADS, max_body=ASYNC_MAX_BODY):
+    """Wrap the WSGI app as an ASGI app for --async
+
+    a2wsgi runs the app in bounded thread pools: POST requests (pattern
+    scoring, code checks, training writes) in one of --threads workers, GET
+    and HEAD requests (status, stats, metrics) in a smaller one, so polling
+    never queues behind slow chats. Bodies declared larger than max_body are
+    refused before they are read.
+    """
+    from a2wsgi import WSGIMiddleware
+
+    def terminated(environ, start_response):
+        # The adapter's input ends with the request body, so a chunked upload
+        # without a Content-Length can still be read to the end
+        environ['wsgi.input_terminated'] = True
+        return wsgi_app(environ, start_response)
+
+    work = WSGIMiddleware(terminated, workers=threads)
+    light = WSGIMiddleware(terminated, workers=max(2, threads // 4))
+
+    async def dispatch(scope, receive, send):
+        if scope['type'] != 'http':
+            return await work(scope, receive, send)
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > max_body:
+                body = json.dumps({'error': 'Payload Too Large'}).encode('utf-8')
+                await send({'type': 'http.response.start', 'status': 413, 'headers': [
+                    (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))
+                ]})
+                await send({'type': 'http.response.body', 'body': body})
+                return
+        pool = light if scope['method'] in ('GET', 'HEAD') else work
+        await pool(scope, receive, send)
+
+    return dispatch
+
+def serve_async(host, port, threads=SERVER_THREADS):
+    """Serve the app from a single process with an asyncio event loop
+
+    Uses uvicorn for connections and keep-alive, so an idle or slow client
+    costs a coroutine instead of a worker thread, and a2wsgi to run the
+    Flask app (see async_app). Conversation logs are already written by the
+    ConversationLogger thread and code runs in the sandbox process pool, so
+    nothing blocks the loop itself.
+    """
+    try:
+        import uvicorn
+        import a2wsgi
+    except ImportError:
+        print("❌ Async mode needs uvicorn and a2wsgi: pip install uvicorn a2wsgi")
+        sys.exit(1)
+
+    # Chunked uploads have no Content-Length, so Flask enforces the limit on those
+    app.config['MAX_CONTENT_LENGTH'] = ASYNC_MAX_BODY
+    # uvicorn re-raises SIGTERM after its graceful shutdown; make that a normal
+    # exit so the log queue is drained
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    get_chatbot().warm_up()
+    try:
+        uvicorn.run(
+            async_app(app, threads),
+            host=host,
+            port=port,
+            lifespan='off',
+            limit_concurrency=ASYNC_MAX_CONNECTIONS,
+            timeout_keep_alive=ASYNC_IDLE_TIMEOUT,
+            timeout_graceful_shutdown=30
+        )
+    finally:
+        shutdown_chatbot()
+
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='PyHub Smart Chatbot Backend')
+    parser.add_argument('--check-matcher', action='store_true',
+                        help='compare the tfidf matcher with the exact scorer on the built-in corpus and exit')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='print a SCORE_CALIBRATION table estimated on the loaded patterns and exit')
+    parser.add_argument('--import-patterns', metavar='FILE',
+                        help='bulk import training patterns from a JSON-lines or CSV file and exit')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='format of --import-patterns (default: from extension)')
+    parser.add_argument('--apply-retention', action='store_true',
+                        help='archive or delete conversations older than PYBOT_RETENTION_DAYS and exit')
+    parser.add_argument('--production', action='store_true',
+                        help='serve with a multi-worker WSGI server instead of the Flask development server')
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='serve from one process with an asyncio event loop; handlers run in --threads workers')
+    parser.add_argument('--host', default='0.0.0.0', help='address to bind (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on (default: 5000)')
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help='worker processes in production mode (default: PYBOT_WORKERS)')
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS,
+                        help='threads per worker in production mode (default: PYBOT_THREADS)')
+    args = parser.parse_args()
+
+    if args.check_matcher:
+        sys.exit(0 if check_matcher_parity(get_chatbot()) else 1)
+
+    if args.calibrate:
+        knots, samples = build_score_calibration(get_chatbot())
+        shutdown_chatbot()
+        print(f"# {samples} scored queries")
+        print("SCORE_CALIBRATION = (")
+        for start in range(0, len(knots), 5):
+            print('    ' + ' '.join(f"{knot}," for knot in knots[start:start + 5]))
+        print(")")
+        sys.exit(0)
+
+    if args.apply_retention:
+        if RETENTION_DAYS <= 0:
+            parser.error('set PYBOT_RETENTION_DAYS to the number of days of conversations to keep')
+        removed = get_chatbot().apply_retention()
+        shutdown_chatbot()
+        verb = 'Archived' if RETENTION_MODE == 'archive' else 'Deleted'
+        print(f"✅ {verb} {removed} conversations older than {RETENTION_DAYS:g} days")
+        sys.exit(0)
+
+    if args.import_patterns:
+        fmt = args.format or training_format(args.import_patterns)
+        if fmt is None:
+            parser.error('cannot tell the format from the file name - pass --format jsonl or --format csv')
+        report = {'skipped': 0, 'errors': []}
+        started = time.perf_counter()
+        with open(args.import_patterns, encoding='utf-8-sig', newline='') as f:
+            counts = get_chatbot().import_patterns(read_training_rows(f, fmt, report))
+        shutdown_chatbot()
+        print(f"✅ Imported {args.import_patterns} in {time.perf_counter() - started:.1f}s: "
+              f"{counts['inserted']} inserted, {counts['updated']} updated, "
+              f"{counts['unchanged']} unchanged, {report['skipped']} skipped")
+        for error in report['errors']:
+            print(f"⚠️ {error}")
+        sys.exit(0)
+
     print("🚀 Starting PyHub Smart Chatbot Backend...")
     print("🤖 Smart Pattern Matching Chatbot ready!")
     print("💾 Using SQLite database for learning")
-    print("🌐 Starting server on http://localhost:5000")
+    print(f"🌐 Starting server on http://localhost:{args.port}")
     print("✅ Compatible with Python 3.13+")
     print("\n📋 Available endpoints:")
     print("  POST /api/chat - Send messages to chatbot")
     print("  GET  /api/status - Check chatbot status")
     print("  GET  /api/stats - View chatbot statistics")
     print("  POST /api/train - Add new training patterns")
+    print("  GET  /api/metrics - Prometheus-style metrics")
     print("\n🎯 Ready to help with Python programming!")
 
-    # Start Flask server
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if args.async_mode:
+        print(f"⚡ Async mode: 1 event loop, {args.threads} handler thread(s)")
+        serve_async(args.host, args.port, args.threads)
+    elif args.production:
+        print(f"🏭 Production mode: {args.workers} worker(s) x {args.threads} thread(s)")
+        serve_production(args.host, args.port, args.workers, args.threads)
+    else:
+        # Start Flask development server
+        app.run(host=args.host, port=args.port, debug=True)